@@ -1,15 +1,15 @@
 import os
-import hashlib
-from io import BytesIO
-from flask import Flask, request, jsonify
+import re
+import threading
+from queue import Queue, Full
+from flask import Flask, Response, request, jsonify
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardMarkup,
-    ReplyKeyboardRemove,
-    Bot
+    ReplyKeyboardRemove
 )
 from telegram.ext import (
     CommandHandler,
@@ -19,92 +19,106 @@ from telegram.ext import (
     Dispatcher,
     CallbackContext
 )
-from qrcode import QRCode
-import cv2
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageOps
+from telegram.utils.request import Request
 import dotenv
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, func
-from sqlalchemy.orm import declarative_base, sessionmaker
-from datetime import datetime
+from sqlalchemy import func, text
+from cache import TTLCache
+from models import Session, DoorSession, User, engine, door_engine, pool_stats, door_pool_stats
+import media
+import stats
+import broadcast
+import writebehind
+import webhook_reply
+import dedupe
+import metrics
+import replica
+import events
+from ratelimit import FloodControl, parse_limits
 
 dotenv.load_dotenv()
 
 app = Flask(__name__)
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHANNEL_NAME = os.getenv("CHANNEL_NAME")
-DATABASE_URL = os.getenv("DATABASE_URL")
-FREE_CODE = os.getenv("SECURITY_CODE")
-
-SECURITY_HASHES = {
-    "free": hashlib.sha256(FREE_CODE.encode()).hexdigest()
-}
-
-engine = create_engine(DATABASE_URL)
-Base = declarative_base()
-Session = sessionmaker(bind=engine)
-
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(String, unique=True)
-    phone = Column(String)
-    telegram_tag = Column(String, nullable=True)
-    has_ticket = Column(Boolean, default=False)
-    on_event = Column(Boolean, default=False)
-    is_admin = Column(Boolean, default=False)
-    is_promoter = Column(Boolean, default=False)
-    promoter = Column(String, nullable=True)
-
-class Registration(Base):
-    __tablename__ = 'registrations'
-    id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-    user_id = Column(String)
-    phone = Column(String)
-
-class Attendance(Base):
-    __tablename__ = 'attendance'
-    id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-    user_id = Column(String)
-    phone = Column(String)
-    ticket_type = Column(String)
-
-Base.metadata.create_all(engine)
-
-bot = Bot(token=TOKEN)
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+HANDLER_THREADS = int(os.getenv("HANDLER_THREADS", "8"))
+# "queue" acknowledges at once and handles updates on HANDLER_THREADS;
+# "inline" handles them in the request and returns the first reply as the response
+WEBHOOK_REPLY_MODE = os.getenv("WEBHOOK_REPLY_MODE", "queue")
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+MEMBER_CACHE_TTL = float(os.getenv("MEMBER_CACHE_TTL", "600"))
+NON_MEMBER_CACHE_TTL = float(os.getenv("NON_MEMBER_CACHE_TTL", "5"))
+# Per user and handler kind: rate per second / burst
+FLOOD_LIMITS = os.getenv(
+    "FLOOD_LIMITS", "start=0.2/3,check_subscription=0.5/3,count=0.5/5,photo=5/20,default=1/10"
+)
+FLOOD_MAX_CONCURRENT = int(os.getenv("FLOOD_MAX_CONCURRENT", str(HANDLER_THREADS)))
+
+COUNT_BUTTONS = ["Сколько проверенных билетов", "Сколько регистраций"]
+ROLE_LIST_MAX_BYTES = int(os.getenv("ROLE_LIST_MAX_BYTES", str(256 * 1024)))
+ROLE_SUMMARY_TAGS = 30
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+membership_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=MEMBER_CACHE_TTL)
+flood = FloodControl(parse_limits(FLOOD_LIMITS), FLOOD_MAX_CONCURRENT)
+
+bot = webhook_reply.WebhookBot(
+    token=TOKEN,
+    base_url=os.getenv("BOT_API_URL"),
+    base_file_url=os.getenv("BOT_FILE_URL"),
+    # Keep-alive connections for every handler thread plus background senders
+    request=Request(con_pool_size=HANDLER_THREADS + 4)
+)
 
+@metrics.timed
 def get_user(user_id):
-    session = Session()
-    user = session.query(User).filter_by(user_id=str(user_id)).first()
-    session.close()
-    return user
+    user = user_cache.get(str(user_id))
+    if user is not None:
+        return user
 
-def update_user(user_id, updates):
     session = Session()
     user = session.query(User).filter_by(user_id=str(user_id)).first()
     if user:
-        for key, value in updates.items():
-            setattr(user, key, value)
-        session.commit()
-    session.close()
+        # Cached users are shared between threads, so detach them from this session
+        session.expunge(user)
+        user_cache.set(str(user_id), user)
+    return user
 
 def setup_dispatcher(dp):
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("promote", promote_user))
-    dp.add_handler(CommandHandler("demote", demote_user))
-    dp.add_handler(CommandHandler("make_promoter", make_promoter))
-    dp.add_handler(MessageHandler(filters.Filters.contact, handle_contact))
-    dp.add_handler(CallbackQueryHandler(check_subscription, pattern="^check_subscription$"))
-    dp.add_handler(MessageHandler(filters.Filters.photo, handle_photo))
-    dp.add_handler(MessageHandler(filters.Filters.text(["Сколько проверенных билетов", "Сколько регистраций"]), show_ticket_count))
-    dp.add_handler(MessageHandler(filters.Filters.text(["Мои приглашенные"]), show_invited_stats))
+    dp.add_handler(CommandHandler("start", metrics.instrument_handler(start)))
+    dp.add_handler(CommandHandler("promote", metrics.instrument_handler(promote_user)))
+    dp.add_handler(CommandHandler("demote", metrics.instrument_handler(demote_user)))
+    dp.add_handler(CommandHandler("make_promoter", metrics.instrument_handler(make_promoter)))
+    dp.add_handler(CommandHandler("leaderboard", metrics.instrument_handler(show_leaderboard)))
+    dp.add_handler(CommandHandler("broadcast", metrics.instrument_handler(start_broadcast)))
+    dp.add_handler(CommandHandler("broadcast_status", metrics.instrument_handler(show_broadcast_status)))
+    dp.add_handler(CommandHandler("open_event", metrics.instrument_handler(open_event)))
+    dp.add_handler(CommandHandler("close_event", metrics.instrument_handler(close_event)))
+    dp.add_handler(CommandHandler("events", metrics.instrument_handler(show_events)))
+    dp.add_handler(MessageHandler(
+        filters.Filters.document & filters.Filters.caption_regex(r"^/(promote|demote|make_promoter)(@\w+)?(\s|$)"),
+        metrics.instrument_handler(handle_role_list)
+    ))
+    dp.add_handler(MessageHandler(filters.Filters.contact, metrics.instrument_handler(handle_contact)))
+    dp.add_handler(CallbackQueryHandler(metrics.instrument_handler(check_subscription), pattern="^check_subscription$"))
+    dp.add_handler(MessageHandler(filters.Filters.photo, metrics.instrument_handler(handle_photo)))
+    dp.add_handler(MessageHandler(filters.Filters.text(COUNT_BUTTONS), metrics.instrument_handler(show_ticket_count)))
+    dp.add_handler(MessageHandler(filters.Filters.text(["Мои приглашенные"]), metrics.instrument_handler(show_invited_stats)))
     return dp
 
+def is_channel_member(user_id):
+    is_member = membership_cache.get(user_id)
+    if is_member is None:
+        member = bot.get_chat_member(f"@{CHANNEL_NAME}", user_id)
+        is_member = member.status in ["member", "administrator", "creator"]
+        membership_cache.set(user_id, is_member, ttl=MEMBER_CACHE_TTL if is_member else NON_MEMBER_CACHE_TTL)
+    return is_member
+
 def is_admin(user_id):
-    user = get_user(user_id)
-    return user.is_admin if user else False
+    # Never from user_cache: a /demote in another worker does not invalidate this one's cache
+    session = Session()
+    return bool(session.query(User.is_admin).filter_by(user_id=str(user_id)).scalar())
 
 def start(update: Update, context: CallbackContext):
     user = update.effective_user
@@ -118,7 +132,15 @@ def start(update: Update, context: CallbackContext):
     if existing_user:
         # Update promoter if provided and user doesn't have one yet
         if promoter_tag and not existing_user.promoter:
-            update_user(user.id, {'promoter': promoter_tag})
+            # The cached user may be stale: only the UPDATE that actually sets the promoter counts the invite
+            session = Session()
+            assigned = session.query(User).filter(
+                User.user_id == str(user.id), User.promoter.is_(None)
+            ).update({"promoter": promoter_tag}, synchronize_session=False)
+            if assigned:
+                stats.record_invite(session, promoter_tag)
+            session.commit()
+            user_cache.invalidate(str(user.id))
         
         buttons = []
         if existing_user.is_admin:
@@ -156,8 +178,12 @@ def start(update: Update, context: CallbackContext):
         promoter=promoter_tag
     )
     session.add(new_user)
+    stats.increment(session, "users")
+    if promoter_tag:
+        stats.record_invite(session, promoter_tag)
     session.commit()
     session.close()
+    user_cache.invalidate(str(user.id))
 
     update.message.reply_text(
         "Регистрация:",
@@ -165,169 +191,215 @@ def start(update: Update, context: CallbackContext):
     )
 
 def show_invited_stats(update: Update, context: CallbackContext):
-    user_id = update.effective_user.id
-    user = get_user(user_id)
+    session = Session()
+    user = session.query(User.is_promoter, User.telegram_tag).filter_by(
+        user_id=str(update.effective_user.id)
+    ).first()
 
     if not user or not user.is_promoter:
         update.message.reply_text("Ты не промоутер")
         return
 
-    session = Session()
-    total_invited = session.query(User).filter_by(promoter=user.telegram_tag).count()
-    attended = session.query(User).join(Attendance, User.user_id == Attendance.user_id).filter(
-        User.promoter == user.telegram_tag
-    ).count()
-    session.close()
+    total_invited, attended = stats.get_promoter(user.telegram_tag, events.current_id())
 
     update.message.reply_text(f"Ты пригласил: {total_invited}\nНа событии были: {attended}")
 
+def show_leaderboard(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
 
-def make_promoter(update: Update, context: CallbackContext):
-    try:
-        sender_id = update.effective_user.id
-        sender = get_user(sender_id)
-        if not sender or not sender.is_admin:
-            update.message.reply_text("У вас нет прав для выполнения этой команды")
-            return
-
-        if not context.args or len(context.args) < 1:
-            update.message.reply_text("Использование: /make_promoter @username")
-            return
-
-        target_tag = context.args[0].lstrip('@')
-        session = Session()
-        target_user = session.query(User).filter(
-            func.lower(User.telegram_tag) == func.lower(target_tag)
-        ).first()
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    rows = stats.leaderboard(limit, events.current_id())
+    if not rows:
+        update.message.reply_text("Пока никого не пригласили")
+        return
 
-        if not target_user:
-            update.message.reply_text("Пользователь не найден")
-            session.close()
-            return
+    lines = []
+    for place, (promoter, invited, attended, by_type) in enumerate(rows, start=1):
+        line = f"{place}. @{promoter}: пришли {attended} из {invited}"
+        if by_type:
+            line += " (" + ", ".join(f"{ticket_type}: {count}" for ticket_type, count in sorted(by_type.items())) + ")"
+        lines.append(line)
+    update.message.reply_text("\n".join(lines))
 
-        if target_user.is_promoter:
-            update.message.reply_text("Этот пользователь уже промоутер")
-            session.close()
-            return
-
-        target_user.is_promoter = True
-        session.commit()
-        update.message.reply_text(f"Пользователь @{target_user.telegram_tag} теперь промоутер")
 
+def run_broadcast(job_id, admin_id):
+    job = broadcast.run_job(job_id)
+    if job:
         try:
-            context.bot.send_message(
-                chat_id=int(target_user.user_id),
-                text="Ты стал промоутером! Используй ссылку:\n"
-                     f"https://t.me/{context.bot.username}?start={target_user.telegram_tag}"
-            )
+            bot.send_message(chat_id=admin_id, text=broadcast.format_job(job))
         except Exception:
             pass
-    except Exception:
-        update.message.reply_text("Ошибка выполнения команды")
-    finally:
-        if 'session' in locals():
-            session.close()
 
+def start_broadcast(update: Update, context: CallbackContext):
+    sender_id = update.effective_user.id
+    if not is_admin(sender_id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
 
-def demote_user(update: Update, context: CallbackContext):
-    try:
-        sender_id = update.effective_user.id
-        sender = get_user(sender_id)
-        if not sender or not sender.is_admin:
-            update.message.reply_text("У вас нет прав для выполнения этой команды")
-            return
+    text = update.message.text.partition(" ")[2].strip()
+    if not text:
+        update.message.reply_text("Использование: /broadcast текст сообщения")
+        return
 
-        if not context.args or len(context.args) < 1:
-            update.message.reply_text("Использование: /demote @username")
-            return
+    job_id = broadcast.create_job(text, sender_id)
+    threading.Thread(target=run_broadcast, args=(job_id, sender_id), name=f"broadcast-{job_id}", daemon=True).start()
+    update.message.reply_text(f"Рассылка #{job_id} запущена. Статус: /broadcast_status {job_id}")
 
-        target_tag = context.args[0].lstrip('@')
-        if not target_tag:
-            update.message.reply_text("Укажи телеграм-тег пользователя (например: /demote @username)")
-            return
+def show_broadcast_status(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
 
-        session = Session()
-        target_user = session.query(User).filter(
-            func.lower(User.telegram_tag) == func.lower(target_tag)
-        ).first()
+    job_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    job = broadcast.get_job(job_id)
+    update.message.reply_text(broadcast.format_job(job) if job else "Рассылка не найдена")
 
-        if not target_user:
-            update.message.reply_text("Пользователь не найден")
-            session.close()
-            return
+def open_event(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
+    if not context.args:
+        update.message.reply_text("Использование: /open_event название")
+        return
 
-        if not target_user.is_admin:
-            update.message.reply_text("Этот пользователь не администратор")
-            session.close()
-            return
+    event = events.open_event(" ".join(context.args))
+    if event is None:
+        update.message.reply_text("Сначала закрой текущее событие: /close_event")
+        return
+    update.message.reply_text(f"Событие #{event.id} «{event.name}» открыто, регистрации и проверки идут в него")
 
-        target_user.is_admin = False
-        session.commit()
-        update.message.reply_text(f"Пользователь @{target_user.telegram_tag} больше не админ")
-        
-        try:
-            context.bot.send_message(
-                chat_id=int(target_user.user_id),
-                text="Тебя уволили! Отправь /start чтобы обновить функционал."
-            )
-        except Exception as e:
-            pass
+def close_event(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
 
-    except Exception as e:
-        update.message.reply_text("Ошибка выполнения команды")
-    finally:
-        if 'session' in locals():
-            session.close()
+    event = events.close_event()
+    if event is None:
+        update.message.reply_text("Нет открытого события")
+        return
+    # on_event was reset for everyone
+    user_cache.clear()
+    update.message.reply_text(events.format_event(
+        event, stats.get("registrations", event.id), stats.get("attendance", event.id)
+    ))
+
+def show_events(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
 
-def promote_user(update: Update, context: CallbackContext):
-    try:
-        sender_id = update.effective_user.id
-        sender = get_user(sender_id)
-        if not sender or not sender.is_admin:
-            update.message.reply_text("У вас нет прав для выполнения этой команды")
-            return
+    rows = events.recent()
+    if not rows:
+        update.message.reply_text("Событий пока не было")
+        return
+    update.message.reply_text("\n".join(events.format_event(*row) for row in rows))
+
+# Role commands: the User column they set, its new value, the summary line and
+# the message sent to every changed user
+ROLE_COMMANDS = {
+    "promote": ("is_admin", True, "Теперь администраторы",
+                "Тебя повысили! Отправь /start чтобы обновить функционал."),
+    "demote": ("is_admin", False, "Больше не админы",
+               "Тебя уволили! Отправь /start чтобы обновить функционал."),
+    "make_promoter": ("is_promoter", True, "Теперь промоутеры",
+                      "Ты стал промоутером! Используй ссылку:\nhttps://t.me/{bot}?start={tag}"),
+}
 
-        if not context.args or len(context.args) < 1:
-            update.message.reply_text("Использование: /promote @username")
-            return
+def parse_tags(text):
+    """Split a list of @tags separated by spaces, commas or newlines, dropping duplicates."""
+    tags = {}
+    for word in re.split(r"[\s,;]+", text):
+        tag = word.lstrip("@")
+        if tag and not word.startswith("/"):
+            tags.setdefault(tag.lower(), tag)
+    return list(tags.values())
+
+def format_tags(tags, limit=ROLE_SUMMARY_TAGS):
+    shown = " ".join(f"@{tag}" for tag in tags[:limit])
+    return shown + (f" и еще {len(tags) - limit}" if len(tags) > limit else "")
+
+def change_roles(update: Update, context: CallbackContext, command, tags):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
 
-        target_tag = context.args[0].lstrip('@')
-        if not target_tag:
-            update.message.reply_text("Укажи телеграм-тег пользователя (например: /promote @username)")
-            return
+    if not tags:
+        update.message.reply_text(
+            f"Использование: /{command} @username [@username ...]\n"
+            f"или отправь файл со списком тегов и подписью /{command}"
+        )
+        return
 
-        session = Session()
-        target_user = session.query(User).filter(
-            func.lower(User.telegram_tag) == func.lower(target_tag)
-        ).first()
+    column, value, changed_title, message = ROLE_COMMANDS[command]
+    session = Session()
+    try:
+        # One lookup for every tag, served by ix_users_telegram_tag_lower
+        users = session.query(User).filter(
+            func.lower(User.telegram_tag).in_([tag.lower() for tag in tags])
+        ).all()
+        changed = [user for user in users if bool(getattr(user, column)) != value]
+        for user in changed:
+            setattr(user, column, value)
+        # Read everything before commit() expires the objects, which would reload each one
+        changed_ids = {user.user_id for user in changed}
+        notifications = [
+            (int(user.user_id), message.format(bot=context.bot.username, tag=user.telegram_tag))
+            for user in changed
+        ]
+        changed_tags = [user.telegram_tag for user in changed]
+        unchanged_tags = [user.telegram_tag for user in users if user.user_id not in changed_ids]
+        session.commit()
+    except Exception:
+        session.rollback()
+        update.message.reply_text("Ошибка выполнения команды")
+        return
+    finally:
+        session.close()
+
+    for user_id in changed_ids:
+        user_cache.invalidate(user_id)
+
+    found = {tag.lower() for tag in changed_tags + unchanged_tags}
+    missing = [tag for tag in tags if tag.lower() not in found]
+    results = broadcast.Broadcaster(context.bot).send_many(notifications)
+
+    lines = [f"Найдено: {len(users)} из {len(tags)}"]
+    if changed_tags:
+        lines.append(f"{changed_title}: {len(changed_tags)} — {format_tags(changed_tags)}")
+    if unchanged_tags:
+        lines.append(f"Без изменений: {len(unchanged_tags)} — {format_tags(unchanged_tags)}")
+    if missing:
+        lines.append(f"Не найдены: {len(missing)} — {format_tags(missing)}")
+    if notifications:
+        lines.append(f"Уведомлены: {results.count('sent')} из {len(notifications)}")
+    update.message.reply_text("\n".join(lines))
 
-        if not target_user:
-            update.message.reply_text("Пользователь не найден")
-            session.close()
-            return
+def make_promoter(update: Update, context: CallbackContext):
+    change_roles(update, context, "make_promoter", parse_tags(" ".join(context.args)))
 
-        if target_user.is_admin:
-            update.message.reply_text("Этот пользователь уже администратор")
-            session.close()
-            return
+def demote_user(update: Update, context: CallbackContext):
+    change_roles(update, context, "demote", parse_tags(" ".join(context.args)))
 
-        target_user.is_admin = True
-        session.commit()
-        update.message.reply_text(f"Пользователь @{target_user.telegram_tag} теперь администратор")
-        
-        try:
-            context.bot.send_message(
-                chat_id=int(target_user.user_id),
-                text="Тебя повысили! Отправь /start чтобы обновить функционал."
-            )
-        except Exception as e:
-            pass
+def promote_user(update: Update, context: CallbackContext):
+    change_roles(update, context, "promote", parse_tags(" ".join(context.args)))
 
-    except Exception as e:
-        update.message.reply_text("Ошибка выполнения команды")
-    finally:
-        if 'session' in locals():
-            session.close()
+def handle_role_list(update: Update, context: CallbackContext):
+    """A document captioned with a role command: apply it to every tag in the file."""
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("У вас нет прав для выполнения этой команды")
+        return
+
+    command = update.message.caption.split()[0][1:].split("@")[0]
+    document = update.message.document
+    if document.file_size and document.file_size > ROLE_LIST_MAX_BYTES:
+        update.message.reply_text("Файл слишком большой")
+        return
+    data = bytes(context.bot.get_file(document.file_id).download_as_bytearray())
+    # Tags may also follow the command in the caption
+    text = update.message.caption + "\n" + data.decode("utf-8", errors="ignore")
+    change_roles(update, context, command, parse_tags(text))
 
 def handle_contact(update: Update, context: CallbackContext):
     user = update.effective_user
@@ -350,8 +422,11 @@ def handle_contact(update: Update, context: CallbackContext):
             promoter=None
         )
         session.add(new_user)
+        stats.increment(session, "users")
         session.commit()
     session.close()
+    user_cache.invalidate(str(user.id))
+    writebehind.registrations.add({"user_id": str(user.id), "phone": phone, "event_id": events.current_id()})
     
     update.message.reply_text(
         "Регистрация успешна! Теперь проверь подписку на канал.",
@@ -373,16 +448,15 @@ def check_subscription(update: Update, context: CallbackContext):
     
     user_id = query.from_user.id
     try:
-        member = bot.get_chat_member(f"@{CHANNEL_NAME}", user_id)
-        if member.status in ["member", "administrator", "creator"]:
+        if is_channel_member(user_id):
             # User is subscribed - send the image
             try:
-                with open('img/free_shot.jpg', 'rb') as photo:
-                    bot.send_photo(
-                        chat_id=user_id,
-                        photo=photo,
-                        caption="Забирай бесплатный шот на ближайшем ивенте"
-                    )
+                media.send_photo(
+                    bot,
+                    user_id,
+                    'img/free_shot.jpg',
+                    caption="Забирай бесплатный шот на ближайшем ивенте"
+                )
                 query.edit_message_text("Отлично! Ты подписан на канал.")
             except FileNotFoundError:
                 query.edit_message_text("Регистрация завершена! Изображение временно недоступно.")
@@ -397,27 +471,44 @@ def check_subscription(update: Update, context: CallbackContext):
             show_alert=True
         )
 
+def is_door_admin(user_id):
+    if not replica.offline():
+        session = DoorSession()
+        try:
+            return bool(session.query(User.is_admin).filter_by(user_id=str(user_id)).scalar())
+        except replica.DB_UNREACHABLE:
+            if replica.CHECK_IN_MODE == "online":
+                raise
+            replica.breaker.trip()
+        finally:
+            session.close()
+    # Keep the door working while the database is unreachable
+    holder = replica.snapshot.lookup(user_id)
+    return bool(holder and holder.is_admin)
+
 def handle_photo(update: Update, context: CallbackContext):
     user_id = update.message.from_user.id
-    if not is_admin(user_id):
+    if not is_door_admin(user_id):
         return
     
     try:
-        # For admin photo processing - keeping this but it won't be used for tickets
-        update.message.reply_text("Фото получено. Функционал проверки билетов отключен.")
+        # cv2, numpy and onnxruntime are only loaded once the first ticket is scanned
+        import scanner
+        result = scanner.scan(context.bot, update.message.photo)
+        if result.status == "ok":
+            user_cache.invalidate(result.user_id)
+        update.message.reply_text(result.message)
     except Exception as e:
         update.message.reply_text(f"Ошибка обработки: {str(e)}")
 
 def show_ticket_count(update: Update, context: CallbackContext):
     text = update.message.text
-    session = Session()
     if text == "Сколько проверенных билетов":
-        count = session.query(Attendance).count()
+        count = stats.get("attendance", events.current_id())
         noun = "билет"
     else:
-        count = session.query(User).count()
+        count = stats.get("users")
         noun = "юзер"
-    session.close()
     
     if 2 <= count % 10 <= 4 and (count % 100 < 10 or count % 100 >= 20):
         noun += "а"
@@ -426,18 +517,174 @@ def show_ticket_count(update: Update, context: CallbackContext):
     
     update.message.reply_text(f"Всего: {count} {noun}")
 
+# One dispatcher per worker process, fed by a bounded queue. Handler threads
+# are started lazily on the first webhook so that they are created after
+# gunicorn forks the worker.
+update_queue = Queue(maxsize=UPDATE_QUEUE_SIZE)
+dispatcher = setup_dispatcher(Dispatcher(bot=bot, update_queue=update_queue))
+_handler_threads = []
+_handler_threads_lock = threading.Lock()
+
+def update_kind(update):
+    """Name the handler an update is headed for, as used by FLOOD_LIMITS."""
+    if update.callback_query:
+        return update.callback_query.data or "callback"
+    message = update.message
+    if message is None:
+        return "default"
+    if message.text and message.text.startswith("/"):
+        # A bare "/" or "/@bot" has no command name
+        parts = message.text[1:].split()
+        return (parts[0].split("@")[0] if parts else "") or "default"
+    if message.text in COUNT_BUTTONS:
+        return "count"
+    if message.contact:
+        return "contact"
+    if message.photo:
+        return "photo"
+    return "default"
+
+def handle_update(update):
+    if not flood.enter():
+        # Every slot has been busy for a while: shed the update instead of queueing it
+        return
+    try:
+        with metrics.track_update(update):
+            dispatcher.process_update(update)
+    finally:
+        # CallbackContext adds an entry per chat and user that no handler here uses;
+        # the dispatcher lives as long as the worker, so drop them before they pile up
+        if update.effective_chat:
+            dispatcher.chat_data.pop(update.effective_chat.id, None)
+        if update.effective_user:
+            dispatcher.user_data.pop(update.effective_user.id, None)
+        Session.remove()
+        flood.leave()
+
+def process_updates():
+    while True:
+        update = update_queue.get()
+        try:
+            handle_update(update)
+        finally:
+            update_queue.task_done()
+
+def start_handler_threads():
+    if _handler_threads:
+        return
+    with _handler_threads_lock:
+        if _handler_threads:
+            return
+        for i in range(HANDLER_THREADS):
+            thread = threading.Thread(target=process_updates, name=f"handler-{i}", daemon=True)
+            thread.start()
+            _handler_threads.append(thread)
+        stats.start_reconciler()
+        replica.start_reconciler()
+        threading.Thread(target=broadcast.resume_jobs, name="broadcast-resume", daemon=True).start()
+
+def warmup():
+    """Load modules and caches, meant to run in the gunicorn master before fork."""
+    # No database connections here, models.py drops the pool in every forked
+    # worker (see warm_pool). No Bot API calls either: a keep-alive socket left
+    # in the bot's pool would be inherited and shared by every worker
+    if os.path.exists(media.MEDIA_REGISTRY):
+        media.get_file_id('img/free_shot.jpg')
+
+    # cv2 and numpy take most of a cold first scan
+    import scanner  # noqa: F401
+    import tickets
+    tickets.load_assets()
+
+def warm_pool():
+    """Open this process's first database connection, meant for gunicorn post_fork."""
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+
 @app.route('/health', methods=['GET'])
 def health_check():
-     return jsonify({"status": "ok"}), 200
+     return jsonify({
+         "status": "ok",
+         "queue_depth": update_queue.qsize(),
+         "queue_size": UPDATE_QUEUE_SIZE,
+         "handler_threads": len(_handler_threads),
+         "user_cache": user_cache.stats(),
+         "membership_cache": membership_cache.stats(),
+         "db_pool": pool_stats.as_dict(engine),
+         "door_db_pool": door_pool_stats.as_dict(door_engine),
+         "dedupe": dedupe.stats(),
+         "flood": flood.stats(),
+         "write_behind": {
+             "registrations": writebehind.registrations.stats(),
+             "attendance": writebehind.attendance.stats()
+         }
+     }), 200
+
+def _register_metrics():
+    metrics.register_callback("update_queue_depth", "gauge", "Updates waiting for a handler thread",
+                              update_queue.qsize)
+    for name, cache in (("user", user_cache), ("membership", membership_cache)):
+        metrics.register_callback(f"{name}_cache_hits_total", "counter", f"{name} cache hits",
+                                  lambda cache=cache: cache.hits)
+        metrics.register_callback(f"{name}_cache_misses_total", "counter", f"{name} cache misses",
+                                  lambda cache=cache: cache.misses)
+    metrics.register_callback("dedupe_duplicates_total", "counter", "Redelivered updates dropped",
+                              lambda: dedupe.stats()["duplicates"])
+    metrics.register_callback("flood_throttled_total", "counter", "Updates dropped by per-user limits",
+                              lambda: [({"kind": kind}, count) for kind, count in flood.stats()["throttled"].items()])
+    metrics.register_callback("flood_overloaded_total", "counter", "Updates shed while every slot was busy",
+                              lambda: flood.overloaded)
+    pools = (("main", pool_stats, engine), ("door", door_pool_stats, door_engine))
+    metrics.register_callback("db_pool_checked_out", "gauge", "Connections currently checked out",
+                              lambda: [({"pool": name}, stats.as_dict(engine)["checked_out"] or 0)
+                                       for name, stats, engine in pools])
+    metrics.register_callback("db_pool_checkout_failures_total", "counter", "Pool checkouts that failed",
+                              lambda: [({"pool": name}, stats.failed) for name, stats, engine in pools])
+    metrics.register_callback("write_behind_pending", "gauge", "Rows buffered and not yet inserted",
+                              lambda: [({"table": buffer.model.__tablename__}, buffer.stats()["pending"])
+                                       for buffer in (writebehind.registrations, writebehind.attendance)])
+    metrics.register_callback("write_behind_dropped_rows_total", "counter", "Rows dropped to the log after failed writes",
+                              lambda: [({"table": buffer.model.__tablename__}, buffer.dropped_rows)
+                                       for buffer in (writebehind.registrations, writebehind.attendance)])
+    metrics.register_callback("door_offline", "gauge", "1 while door scans go straight to the replica",
+                              lambda: int(replica.offline()))
+
+_register_metrics()
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.post("/webhook")
 def webhook():
-    dp = Dispatcher(bot=bot, update_queue=None)
-    dp = setup_dispatcher(dp)
-    
-    update = Update.de_json(request.get_json(), bot)
-    dp.process_update(update)
-    return jsonify({"status": "ok"})
+    start_handler_threads()
+
+    data = request.get_json()
+    update_id = data.get("update_id")
+    if dedupe.is_duplicate(update_id):
+        # A retry of an update we already accepted: acknowledge it and do nothing
+        return jsonify({"status": "ok", "duplicate": True})
+
+    update = Update.de_json(data, bot)
+    user = update.effective_user
+    if user and not flood.allow(user.id, update_kind(update)):
+        if update.callback_query:
+            # Stop the button's spinner without an outbound call
+            return jsonify({"method": "answerCallbackQuery", "callback_query_id": update.callback_query.id})
+        return jsonify({"status": "ok", "throttled": True})
+
+    if WEBHOOK_REPLY_MODE == "inline":
+        with webhook_reply.capture() as captured:
+            handle_update(update)
+        return jsonify(captured.response or {"status": "ok"})
+
+    try:
+        update_queue.put_nowait(update)
+    except Full:
+        # Let Telegram redeliver once the backlog drains
+        dedupe.forget(update_id)
+        return jsonify({"status": "busy", "queue_depth": update_queue.qsize()}), 503
+    return jsonify({"status": "ok", "queue_depth": update_queue.qsize()})
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=1612)
\ No newline at end of file
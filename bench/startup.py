@@ -0,0 +1,54 @@
+"""Measure how long a fresh worker takes to import app.py.
+
+    python bench/startup.py [--runs 5]
+
+Compares importing app against importing it together with the heavy modules
+that are now loaded lazily, i.e. what every worker used to pay at boot.
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ["cv2", "numpy", "onnxruntime", "qrcode", "PIL.Image"]
+
+SNIPPET = """
+import sys, time
+started = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - started
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def measure(imports, runs, env):
+    code = SNIPPET.format(imports=imports, heavy=HEAVY)
+    timings, loaded = [], ""
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=ROOT, env=env, check=True, capture_output=True, text=True
+        ).stdout.split()
+        timings.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ""
+    return statistics.median(timings), loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark worker startup")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite:///:memory:")
+    env.setdefault("TELEGRAM_TOKEN", "123:bench")
+    env.setdefault("SECURITY_CODE", "bench")
+
+    lazy, lazy_loaded = measure("import app", args.runs, env)
+    eager, _ = measure("import app\n" + "\n".join(f"import {name}" for name in HEAVY), args.runs, env)
+
+    print(f"import app (lazy):           {lazy * 1000:8.1f} ms  heavy modules loaded: {lazy_loaded or 'none'}")
+    print(f"import app + heavy (before): {eager * 1000:8.1f} ms")
+    print(f"saved per worker boot:       {(eager - lazy) * 1000:8.1f} ms")
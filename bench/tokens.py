@@ -0,0 +1,71 @@
+"""Measure ticket token verification throughput.
+
+    python bench/tokens.py [--tokens 100000] [--processes N]
+
+Verifies a batch of valid and forged tokens on one core, then on N
+processes to show how it scales.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TICKET_KEYS", "1:bench-old-key,2:bench-key")
+os.environ.setdefault("TICKET_KEY_ID", "2")
+os.environ.setdefault("SECURITY_CODE", "bench")
+
+import tokens  # noqa: E402
+
+
+def make_payloads(count):
+    rng = random.Random(42)
+    payloads = []
+    for i in range(count):
+        user_id = rng.randrange(10 ** 9, 8 * 10 ** 9)
+        ticket_type = rng.choice(tokens.TICKET_TYPES)
+        token = tokens.sign(user_id, ticket_type, key_id=rng.choice((1, 2)))
+        if i % 10 == 0:
+            # Flip one character so a tenth of the batch fails the MAC check
+            token = token[:-1] + ("A" if token[-1] != "A" else "B")
+        payloads.append(token)
+    return payloads
+
+
+def verify_all(payloads):
+    started = time.perf_counter()
+    valid = sum(tokens.verify(payload) is not None for payload in payloads)
+    return valid, time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ticket token verification")
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.tokens)
+    print(f"token length: {tokens.TOKEN_LENGTH} chars")
+
+    started = time.perf_counter()
+    for payload in payloads[:10000]:
+        tokens.sign(1234567890, "vip")
+    sign_rate = 10000 / (time.perf_counter() - started)
+
+    valid, elapsed = verify_all(payloads)
+    print(f"sign, 1 core:      {sign_rate:12,.0f} tokens/s")
+    print(f"verify, 1 core:    {len(payloads) / elapsed:12,.0f} tokens/s  "
+          f"({elapsed / len(payloads) * 1e6:.2f} us each, {valid} valid)")
+
+    if args.processes > 1:
+        chunks = [payloads[i::args.processes] for i in range(args.processes)]
+        with ProcessPoolExecutor(args.processes) as pool:
+            list(pool.map(verify_all, [chunk[:100] for chunk in chunks]))  # warm up the workers
+            started = time.perf_counter()
+            results = list(pool.map(verify_all, chunks))
+            wall = time.perf_counter() - started
+        per_core = sum(len(chunk) / seconds for chunk, (_, seconds) in zip(chunks, results)) / args.processes
+        print(f"verify, {args.processes} procs:  {len(payloads) / wall:12,.0f} tokens/s  "
+              f"({per_core:,.0f} per core)")
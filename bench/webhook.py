@@ -0,0 +1,274 @@
+"""Load-test the /webhook path with synthetic updates.
+
+    python bench/webhook.py [--updates 2000] [--concurrency 8] [--save baseline.json]
+    python bench/webhook.py --compare baseline.json
+
+Runs the Flask app in-process against fake_bot_api.py and a throwaway SQLite
+database (or --database-url for a local Postgres), in inline reply mode so that
+every request covers the whole handler. Reports throughput and p50/p95/p99 per
+kind of update; --save records them and --compare checks a run against them.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Share of each kind of update in the mix, roughly a door rush
+MIX = {
+    "start_new": 20,
+    "contact": 15,
+    "start_existing": 15,
+    "check_subscription": 20,
+    "admin_count": 10,
+    "leaderboard": 5,
+    "photo": 15,
+}
+ADMIN_ID = 1
+TICKET_HOLDERS = 2000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure(args, api_url, workdir):
+    os.environ.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "TELEGRAM_TOKEN": "123456:BENCHMARKbenchmarkBENCHMARKbenchmark",
+        "SECURITY_CODE": "bench",
+        "CHANNEL_NAME": "underloft_bench",
+        "BOT_API_URL": f"{api_url}/bot",
+        "BOT_FILE_URL": f"{api_url}/file/bot",
+        "WEBHOOK_REPLY_MODE": "inline",
+        "MEDIA_REGISTRY": os.path.join(workdir, "file_ids.json"),
+        "STATS_LOCK_PATH": os.path.join(workdir, "stats.lock"),
+        # Measure the handlers, not the flood limits
+        "FLOOD_LIMITS": "default=100000/100000",
+        "FLOOD_MAX_CONCURRENT": str(args.concurrency * 2),
+        "HANDLER_THREADS": str(args.concurrency),
+        "DB_POOL_SIZE": str(args.concurrency + 2),
+    })
+
+
+def seed(photos):
+    """Create the admin and ticket holders, and render tickets for the photo updates."""
+    import tickets
+    from models import Session, User, init_db
+
+    init_db()
+    session = Session()
+    session.add(User(user_id=str(ADMIN_ID), telegram_tag="bench_admin", is_admin=True, is_promoter=True))
+    for i in range(TICKET_HOLDERS):
+        session.add(User(
+            user_id=str(10 ** 6 + i), telegram_tag=f"holder{i}", phone=f"+7900{i:07d}", has_ticket=True,
+            ticket_type=tickets.TICKET_TYPES[i % len(tickets.TICKET_TYPES)], promoter="bench_admin",
+        ))
+    session.commit()
+    Session.remove()
+
+    files = {}
+    for i in range(photos):
+        user_id = 10 ** 6 + i
+        files[f"ticket{i}"] = tickets.render_ticket_bytes(
+            tickets.TICKET_TYPES[i % len(tickets.TICKET_TYPES)], user_id, f"holder{i}"
+        )
+    return files
+
+
+class Updates:
+    """Builds synthetic Telegram updates; every update and new user gets a fresh id."""
+
+    def __init__(self, photos):
+        self.photos = photos
+        self._update_id = 0
+        self._new_user = 5 * 10 ** 6
+        self._photo = 0
+        self._lock = threading.Lock()
+
+    def _next(self, attr):
+        with self._lock:
+            value = getattr(self, attr)
+            setattr(self, attr, value + 1)
+            return value
+
+    def _message(self, user_id, **fields):
+        return {
+            "update_id": self._next("_update_id"),
+            "message": {
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench", "username": f"user{user_id}"},
+                **fields,
+            },
+        }
+
+    def _command(self, user_id, text):
+        command = text.split()[0]
+        return self._message(user_id, text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+
+    def build(self, kind):
+        holder = 10 ** 6 + random.randrange(TICKET_HOLDERS)
+        if kind == "start_new":
+            return self._command(self._next("_new_user"), "/start bench_admin")
+        if kind == "contact":
+            user_id = self._next("_new_user")
+            return self._message(user_id, contact={"phone_number": f"+7999{user_id:07d}", "user_id": user_id,
+                                                   "first_name": "bench"})
+        if kind == "start_existing":
+            return self._command(holder, "/start")
+        if kind == "check_subscription":
+            return {
+                "update_id": self._next("_update_id"),
+                "callback_query": {
+                    "id": str(self._update_id), "chat_instance": "bench", "data": "check_subscription",
+                    "from": {"id": holder, "is_bot": False, "first_name": "bench"},
+                    "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": holder, "type": "private"},
+                                "text": "Подпишись"},
+                },
+            }
+        if kind == "admin_count":
+            return self._message(ADMIN_ID, text=random.choice(["Сколько проверенных билетов", "Сколько регистраций"]))
+        if kind == "leaderboard":
+            return self._command(ADMIN_ID, "/leaderboard")
+        if kind == "photo":
+            # Each ticket admits once, later scans of it exercise the "used" path
+            file_id = f"ticket{self._next('_photo') % self.photos}"
+            return self._message(ADMIN_ID, photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 1080, "height": 1920}
+            ])
+        raise ValueError(kind)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies, elapsed):
+    results = {}
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        results[kind] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {"updates": total, "seconds": elapsed, "throughput": total / elapsed, "handlers": results}
+
+
+def run(args):
+    import app
+
+    updates = Updates(args.photos)
+    kinds = random.choices(list(MIX), weights=list(MIX.values()), k=args.updates)
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    local = threading.local()
+
+    def send(kind):
+        if not hasattr(local, "client"):
+            local.client = app.app.test_client()
+        update = updates.build(kind)
+        started = time.perf_counter()
+        response = local.client.post("/webhook", json=update)
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            errors[kind] += 1
+        latencies[kind].append(elapsed)
+
+    # Warm up imports, caches and connections outside the measurement
+    for kind in MIX:
+        send(kind)
+    latencies.clear()
+    errors.clear()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(send, kinds))
+    summary = summarize(latencies, time.perf_counter() - started)
+    # Flush buffered rows while the temporary database still exists
+    import writebehind
+    writebehind.close_all()
+    summary["errors"] = dict(errors)
+    summary["config"] = {"concurrency": args.concurrency, "api_latency_ms": args.api_latency,
+                         "database": "postgresql" if args.database_url else "sqlite"}
+    return summary
+
+
+def report(summary, baseline=None, tolerance=0.2, min_delta_ms=5):
+    """Print the run (and its change against baseline); return the regressions."""
+    regressions = []
+    print(f"{summary['updates']} updates in {summary['seconds']:.2f}s: {summary['throughput']:.1f} updates/s")
+    if baseline:
+        change = summary["throughput"] / baseline["throughput"] - 1
+        print(f"  throughput vs baseline: {change:+.1%}")
+        if change < -tolerance:
+            regressions.append("throughput")
+    print(f"{'handler':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, stats in summary["handlers"].items():
+        line = f"{kind:<20}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        before = (baseline or {}).get("handlers", {}).get(kind)
+        if before:
+            changes = {key: stats[key] / before[key] - 1 for key in ("p50_ms", "p95_ms", "p99_ms") if before[key]}
+            line += "   " + " ".join(f"{key[:3]} {value:+.0%}" for key, value in changes.items())
+            # Ignore relative jumps of a few milliseconds, they are scheduling noise
+            if changes.get("p95_ms", 0) > tolerance and stats["p95_ms"] - before["p95_ms"] > min_delta_ms:
+                regressions.append(kind)
+        print(line)
+    if summary["errors"]:
+        print(f"non-200 responses: {summary['errors']}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the webhook path with synthetic updates")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent webhook requests")
+    parser.add_argument("--photos", type=int, default=50, help="distinct ticket photos to scan")
+    parser.add_argument("--api-latency", type=float, default=0, help="fake Bot API latency in ms")
+    parser.add_argument("--database-url", default=None, help="local Postgres to use instead of SQLite")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", metavar="PATH", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fail --compare when p95 grows or throughput drops by more than this")
+    parser.add_argument("--min-delta-ms", type=float, default=5,
+                        help="p95 growth in ms below which a handler never counts as regressed")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    from fake_bot_api import FakeBotAPI
+
+    with tempfile.TemporaryDirectory() as workdir:
+        api = FakeBotAPI(("127.0.0.1", free_port()), latency=args.api_latency / 1000).start()
+        configure(args, api.url, workdir)
+        # Templates and fonts are loaded relative to the repository
+        os.chdir(ROOT)
+        api.files.update(seed(args.photos))
+        summary = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = report(summary, baseline, args.tolerance, args.min_delta_ms)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Baseline written to {args.save}")
+    if regressions:
+        print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
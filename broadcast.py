@@ -0,0 +1,293 @@
+import os
+import sys
+import time
+import uuid
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import dotenv
+from sqlalchemy import update, or_, and_
+from telegram import Bot
+from telegram.error import RetryAfter, Unauthorized, BadRequest, NetworkError
+from telegram.utils.request import Request
+from models import Session, User, BroadcastJob
+from ratelimit import TokenBucket
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TOKEN = os.getenv("TELEGRAM_TOKEN")
+BOT_API_URL = os.getenv("BOT_API_URL")
+BOT_FILE_URL = os.getenv("BOT_FILE_URL")
+# Telegram allows about 30 messages per second across all chats
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_MIN_RATE = float(os.getenv("BROADCAST_MIN_RATE", "1"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "500"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+# A running job whose heartbeat is older than this is considered crashed
+BROADCAST_STALE_AFTER = int(os.getenv("BROADCAST_STALE_AFTER", "120"))
+# How often a running job refreshes its heartbeat, independently of chunk progress
+BROADCAST_HEARTBEAT = float(os.getenv("BROADCAST_HEARTBEAT", "15"))
+
+
+def make_bot():
+    """Bot with a connection pool large enough for concurrent sends."""
+    return Bot(
+        token=TOKEN,
+        base_url=BOT_API_URL,
+        base_file_url=BOT_FILE_URL,
+        request=Request(con_pool_size=BROADCAST_CONCURRENCY + 2)
+    )
+
+
+def create_job(text, created_by=None):
+    session = Session()
+    try:
+        job = BroadcastJob(text=text, created_by=str(created_by) if created_by else None)
+        session.add(job)
+        session.commit()
+        return job.id
+    finally:
+        session.close()
+
+
+def get_job(job_id=None):
+    session = Session()
+    try:
+        query = session.query(BroadcastJob)
+        if job_id is None:
+            return query.order_by(BroadcastJob.id.desc()).first()
+        return session.get(BroadcastJob, job_id)
+    finally:
+        session.close()
+
+
+def claim(job_id):
+    """Take over a pending or crashed job, returning an owner token or None if another worker owns it."""
+    session = Session()
+    try:
+        owner = uuid.uuid4().hex
+        stale = datetime.utcnow() - timedelta(seconds=BROADCAST_STALE_AFTER)
+        claimed = session.execute(
+            update(BroadcastJob).where(
+                BroadcastJob.id == job_id,
+                or_(
+                    BroadcastJob.status == 'pending',
+                    and_(BroadcastJob.status == 'running', BroadcastJob.heartbeat_at < stale)
+                )
+            ).values(status='running', owner=owner, heartbeat_at=datetime.utcnow())
+        ).rowcount
+        session.commit()
+        return owner if claimed else None
+    finally:
+        session.close()
+
+
+def update_owned(job_id, owner, **values):
+    """Update a job and its heartbeat; False once another worker has taken it over."""
+    session = Session()
+    try:
+        updated = session.execute(
+            update(BroadcastJob).where(BroadcastJob.id == job_id, BroadcastJob.owner == owner)
+            .values(heartbeat_at=datetime.utcnow(), **values)
+        ).rowcount
+        session.commit()
+        return bool(updated)
+    finally:
+        session.close()
+
+
+def resumable_jobs():
+    session = Session()
+    try:
+        stale = datetime.utcnow() - timedelta(seconds=BROADCAST_STALE_AFTER)
+        return [job_id for job_id, in session.query(BroadcastJob.id).filter(
+            or_(
+                BroadcastJob.status == 'pending',
+                and_(BroadcastJob.status == 'running', BroadcastJob.heartbeat_at < stale)
+            )
+        ).order_by(BroadcastJob.id)]
+    finally:
+        session.close()
+
+
+def format_job(job):
+    throughput = job.sent / job.elapsed if job.elapsed else 0
+    return (
+        f"Рассылка #{job.id}: {job.status}\n"
+        f"Отправлено: {job.sent}\n"
+        f"Ошибки: {job.failed}\n"
+        f"Заблокировали бота: {job.blocked}\n"
+        f"Скорость: {throughput:.1f} сообщ./с"
+    )
+
+
+class Broadcaster:
+    """Sends a job's text to every user, adapting its rate to Telegram's flood limits.
+
+    Each recipient gets one message per job, so the per-chat limit is never the
+    bottleneck; the global rate starts at BROADCAST_RATE, is halved on every
+    RetryAfter and creeps back up while sends succeed.
+    """
+
+    def __init__(self, bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.max_rate = rate
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, capacity=max(1, concurrency))
+        self._paused_until = 0
+        self._lock = threading.Lock()
+        # Set when the job was taken over elsewhere: pending sends are dropped
+        self._stopped = threading.Event()
+
+    def _backoff(self, retry_after):
+        with self._lock:
+            now = time.monotonic()
+            # Concurrent sends hit the same flood wait, slow down once per wait
+            if now >= self._paused_until:
+                self.bucket.set_rate(max(BROADCAST_MIN_RATE, self.bucket.rate / 2))
+            self._paused_until = max(self._paused_until, now + retry_after)
+        logger.warning("broadcast flood wait %ss, rate now %.1f/s", retry_after, self.bucket.rate)
+
+    def _recover(self):
+        if self.bucket.rate < self.max_rate:
+            with self._lock:
+                self.bucket.set_rate(min(self.max_rate, self.bucket.rate + 0.1))
+
+    def send(self, chat_id, text):
+        """Return 'sent', 'blocked', 'failed' or 'skipped' once the job is stopped."""
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                self._stopped.wait(pause)
+            self.bucket.acquire()
+            if self._stopped.is_set():
+                return 'skipped'
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text)
+                self._recover()
+                return 'sent'
+            except RetryAfter as e:
+                self._backoff(e.retry_after)
+            except Unauthorized:
+                return 'blocked'
+            except BadRequest:
+                return 'failed'
+            except NetworkError:
+                time.sleep(min(2 ** attempt, 30))
+        return 'failed'
+
+    def send_many(self, messages):
+        """Send [(chat_id, text)] concurrently, returning each send's result in order."""
+        if not messages:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(messages)),
+                                thread_name_prefix="notify") as pool:
+            return list(pool.map(lambda message: self.send(*message), messages))
+
+    def _heartbeat(self, job_id, owner):
+        # A chunk can take minutes at the minimum rate, longer than BROADCAST_STALE_AFTER
+        try:
+            while not self._stopped.wait(BROADCAST_HEARTBEAT):
+                try:
+                    if not update_owned(job_id, owner):
+                        logger.warning("broadcast %s was taken over by another worker, stopping", job_id)
+                        self._stopped.set()
+                except Exception:
+                    logger.exception("broadcast %s heartbeat failed", job_id)
+        finally:
+            Session.remove()
+
+    def run(self, job_id, owner):
+        """Send a claimed job to the end; None if another worker took it over meanwhile."""
+        job = get_job(job_id)
+        text, checkpoint, elapsed_before = job.text, job.checkpoint, job.elapsed
+        started = time.monotonic()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, owner),
+                                     name=f"broadcast-{job_id}-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="broadcast") as pool:
+                while True:
+                    # Keyset pagination keeps each chunk query cheap on a large users table
+                    session = Session()
+                    try:
+                        chunk = session.query(User.id, User.user_id).filter(
+                            User.id > checkpoint,
+                            User.user_id.isnot(None)
+                        ).order_by(User.id).limit(BROADCAST_CHUNK).all()
+                    finally:
+                        session.close()
+                    if not chunk:
+                        break
+
+                    results = list(pool.map(lambda row: self.send(int(row.user_id), text), chunk))
+                    checkpoint = chunk[-1].id
+                    if self._stopped.is_set() or not update_owned(
+                        job_id, owner,
+                        sent=BroadcastJob.sent + results.count('sent'),
+                        failed=BroadcastJob.failed + results.count('failed'),
+                        blocked=BroadcastJob.blocked + results.count('blocked'),
+                        checkpoint=checkpoint,
+                        elapsed=elapsed_before + time.monotonic() - started,
+                    ):
+                        logger.warning("broadcast %s lost to another worker at checkpoint %s", job_id, checkpoint)
+                        return None
+
+            if not update_owned(job_id, owner, status='done', finished_at=datetime.utcnow()):
+                return None
+            job = get_job(job_id)
+            logger.info("broadcast %s done: %s", job.id, format_job(job).replace("\n", "; "))
+            return job
+        finally:
+            self._stopped.set()
+            heartbeat.join()
+            Session.remove()
+
+
+def run_job(job_id, bot=None):
+    """Claim and run a job, returning the finished job or None if it is owned elsewhere."""
+    owner = claim(job_id)
+    if owner is None:
+        return None
+    return Broadcaster(bot or make_bot()).run(job_id, owner)
+
+
+def resume_jobs(bot=None):
+    for job_id in resumable_jobs():
+        try:
+            run_job(job_id, bot)
+        except Exception:
+            logger.exception("broadcast %s failed", job_id)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Send a message to every user")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    send_parser = subparsers.add_parser("send", help="create and run a broadcast")
+    send_parser.add_argument("text")
+    resume_parser = subparsers.add_parser("resume", help="resume pending or crashed broadcasts")
+    resume_parser.add_argument("job_id", nargs="?", type=int)
+    status_parser = subparsers.add_parser("status", help="show a broadcast's progress")
+    status_parser.add_argument("job_id", nargs="?", type=int)
+    args = parser.parse_args()
+
+    if args.command == "send":
+        job = run_job(create_job(args.text))
+    elif args.command == "resume" and args.job_id is None:
+        resume_jobs()
+        job = get_job()
+    elif args.command == "resume":
+        job = run_job(args.job_id)
+    else:
+        job = get_job(args.job_id)
+
+    if job is None:
+        print("No such broadcast or it is running elsewhere")
+        sys.exit(1)
+    print(format_job(job))
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    With maxbytes set, sizeof(value) is also kept under maxbytes in total.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        value, _ = self._data.pop(key)
+        self.bytes -= self.sizeof(value)
+
+    def _store(self, key, value, expires_at):
+        if key in self._data:
+            self._pop(key)
+        self._data[key] = (value, expires_at)
+        self.bytes += self.sizeof(value)
+        while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+            self._pop(next(iter(self._data)))
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def add(self, key, value=True, ttl=None):
+        """Store key only if it is absent or expired; return whether it was stored."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+            self._store(key, value, now + (self.ttl if ttl is None else ttl))
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        stats = {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+        if self.maxbytes is not None:
+            stats["bytes"] = self.bytes
+        return stats
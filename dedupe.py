@@ -0,0 +1,72 @@
+import os
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import insert, delete
+from sqlalchemy.exc import IntegrityError
+from cache import TTLCache
+from models import engine, ProcessedUpdate
+
+logger = logging.getLogger(__name__)
+
+# "memory" dedupes within one worker, "db" shares seen update ids between workers
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "memory")
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "50000"))
+# Telegram gives up redelivering an update well within an hour
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "3600"))
+DEDUP_PRUNE_EVERY = 1000
+
+_seen = TTLCache(maxsize=DEDUP_WINDOW, ttl=DEDUP_TTL)
+_lock = threading.Lock()
+_inserts = 0
+duplicates = 0
+
+
+def _claim_shared(update_id):
+    global _inserts
+    try:
+        with engine.begin() as conn:
+            conn.execute(insert(ProcessedUpdate).values(update_id=update_id, received_at=datetime.utcnow()))
+    except IntegrityError:
+        return False
+
+    with _lock:
+        _inserts += 1
+        prune = _inserts % DEDUP_PRUNE_EVERY == 0
+    if prune:
+        with engine.begin() as conn:
+            conn.execute(delete(ProcessedUpdate).where(
+                ProcessedUpdate.received_at < datetime.utcnow() - timedelta(seconds=DEDUP_TTL)
+            ))
+    return True
+
+
+def is_duplicate(update_id):
+    """Record update_id as seen; return True if it was already seen."""
+    global duplicates
+    if update_id is None:
+        return False
+
+    duplicate = not _seen.add(update_id)
+    if not duplicate and DEDUP_BACKEND == "db":
+        try:
+            duplicate = not _claim_shared(update_id)
+        except Exception:
+            # Never drop an update because the shared window is unavailable
+            logger.exception("shared dedupe check failed")
+    if duplicate:
+        with _lock:
+            duplicates += 1
+    return duplicate
+
+
+def forget(update_id):
+    """Let a redelivery of update_id through, e.g. after refusing it with 503."""
+    _seen.invalidate(update_id)
+    if DEDUP_BACKEND == "db":
+        with engine.begin() as conn:
+            conn.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_id == update_id))
+
+
+def stats():
+    return {"backend": DEDUP_BACKEND, "window": len(_seen), "duplicates": duplicates}
@@ -1,39 +1,223 @@
 import os
+import json
+import gzip
+import time
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlsplit, unquote
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2 import sql
 
 load_dotenv()
 
 database_url = os.getenv('DATABASE_URL')
 
-parsed_url = urlsplit(database_url)
+parsed_url = urlsplit(database_url or '')
 
-db_username = unquote(parsed_url.username)
+db_username = unquote(parsed_url.username) if parsed_url.username else None
 db_password = unquote(parsed_url.password) if parsed_url.password else None
 db_host = parsed_url.hostname
 db_port = parsed_url.port if parsed_url.port else 5432
 db_name = unquote(parsed_url.path[1:])
 
-conn = psycopg2.connect(
-    dbname=db_name,
-    user=db_username,
-    password=db_password,
-    host=db_host,
-    port=db_port
-)
-
-output_filename = 'data/users_dacha_new_new.csv'
-
-try:
-    with conn.cursor() as cursor, open(output_filename, 'w') as csv_file:
-        cursor.copy_expert(
-            '''COPY (select * from users where promoter = 'kerri_derri') TO STDOUT WITH CSV HEADER''',
-            csv_file
-        )
-    print(f"Successfully exported to {output_filename}")
-except Exception as e:
-    print(f"Error: {e}")
-finally:
-    if conn:
-        conn.close()
\ No newline at end of file
+STATE_FILE = '.export_state.json'
+PARQUET_BATCH = 100_000
+# Ids are taken in insert order but committed in any order (concurrent write-behind
+# flushes, replica reconcile), so a row can appear below the mark after an export.
+# Incremental exports re-read this many ids below the mark and skip the ones seen.
+SAFETY_WINDOW = 10_000
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=db_name,
+        user=db_username,
+        password=db_password,
+        host=db_host,
+        port=db_port
+    )
+
+
+def load_state(output_dir):
+    try:
+        with open(os.path.join(output_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(output_dir, state):
+    path = os.path.join(output_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def build_query(table, where, column, low, high, seen=()):
+    conditions = [sql.SQL('({})').format(sql.SQL(where))] if where else []
+    if low is not None:
+        conditions.append(sql.SQL('{} > {}').format(sql.Identifier(column), sql.Literal(low)))
+    if seen:
+        conditions.append(sql.SQL('NOT ({} = ANY({}))').format(sql.Identifier(column), sql.Literal(list(seen))))
+    if high is not None:
+        conditions.append(sql.SQL('{} <= {}').format(sql.Identifier(column), sql.Literal(high)))
+    query = sql.SQL('SELECT * FROM {}').format(sql.Identifier(table))
+    if conditions:
+        query += sql.SQL(' WHERE ') + sql.SQL(' AND ').join(conditions)
+    return query + sql.SQL(' ORDER BY {}').format(sql.Identifier(column))
+
+
+def write_csv_gz(conn, query, path, append):
+    exists = append and os.path.exists(path)
+    copy = sql.SQL('COPY ({}) TO STDOUT WITH CSV{}').format(query, sql.SQL('' if exists else ' HEADER'))
+    # Appending adds a new gzip member, which readers treat as one continuous stream
+    with conn.cursor() as cursor, gzip.open(path, 'ab' if exists else 'wb', compresslevel=6) as out:
+        cursor.copy_expert(copy.as_string(conn), out)
+        return cursor.rowcount
+
+
+def arrow_schema(description):
+    """One schema per table, from the column types, never from the values of a batch:
+    a column that is NULL throughout the first batch would otherwise be typed null."""
+    import pyarrow as pa
+
+    # Postgres type OID -> Arrow type; anything else (numeric, json, ...) is exported as text
+    types = {
+        16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(), 701: pa.float64(),
+        1082: pa.date32(), 1114: pa.timestamp('us'), 1184: pa.timestamp('us', tz='UTC'),
+    }
+    return pa.schema([pa.field(column.name, types.get(column.type_code, pa.string())) for column in description])
+
+
+def write_parquet(conn, query, directory, part_name, append):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if not append and os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-{part_name}.parquet')
+
+    writer = None
+    rows = 0
+    # Named cursor streams rows from the server instead of loading the table
+    with conn.cursor(name='export') as cursor:
+        cursor.itersize = PARQUET_BATCH
+        cursor.execute(query)
+        while True:
+            batch = cursor.fetchmany(PARQUET_BATCH)
+            if not batch:
+                break
+            if writer is None:
+                # A named cursor only has a description once the first rows arrive
+                schema = arrow_schema(cursor.description)
+                text = [i for i, field in enumerate(schema) if pa.types.is_string(field.type)]
+                writer = pq.ParquetWriter(path, schema, compression='zstd')
+            records = []
+            for row in batch:
+                row = list(row)
+                for i in text:
+                    if row[i] is not None and not isinstance(row[i], str):
+                        row[i] = str(row[i])
+                records.append(dict(zip(schema.names, row)))
+            writer.write_table(pa.Table.from_pylist(records, schema=schema))
+            rows += len(batch)
+    if writer is not None:
+        writer.close()
+    return rows
+
+
+def export_table(table, where, column, output_dir, fmt, incremental, previous, window=SAFETY_WINDOW):
+    """Export rows past the previous mark; return (table, rows, mark, ids seen just below the mark).
+
+    Only integer marks get the safety window. A timestamp column is unsafe as a
+    mark: rows commit late with earlier timestamps (replica reconcile replays
+    check-ins with the time they happened) and are skipped for good.
+    """
+    conn = connect()
+    # The mark, the window and the export must all see the same committed rows
+    conn.set_session(isolation_level='REPEATABLE READ')
+    try:
+        resumable = incremental and previous.get('column') == column and previous.get('where') == where
+        low = previous.get('value') if resumable else None
+        filtered = sql.SQL(f' WHERE ({where})' if where else '')
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('SELECT max({}) FROM {}{}').format(
+                sql.Identifier(column), sql.Identifier(table), filtered
+            ))
+            high = cursor.fetchone()[0]
+        if high is None:
+            return table, 0, low, previous.get('seen', []) if resumable else []
+
+        seen, recent = [], []
+        if isinstance(high, int):
+            if isinstance(low, int):
+                seen, low = previous.get('seen', []), low - window
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL('SELECT {0} FROM {1}{2}{3} {0} > {4}').format(
+                    sql.Identifier(column), sql.Identifier(table), filtered,
+                    sql.SQL(' AND' if where else ' WHERE'), sql.Literal(high - window)
+                ))
+                # Everything visible in the window is exported once this run commits
+                recent = [row[0] for row in cursor]
+
+        # The upper bound pins the exported range to the high-water mark recorded below
+        query = build_query(table, where, column, low, high, seen)
+        if fmt == 'parquet':
+            # Late rows can arrive while the mark stays put, so parts are also named by run time
+            part_name = f"{str(high).replace(' ', 'T')}-{int(time.time())}"
+            rows = write_parquet(conn, query, os.path.join(output_dir, table), part_name, low is not None)
+        else:
+            rows = write_csv_gz(conn, query, os.path.join(output_dir, f'{table}.csv.gz'), low is not None)
+        conn.commit()
+        return table, rows, high if isinstance(high, (int, float)) else str(high), recent
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export tables with COPY on parallel connections')
+    parser.add_argument('tables', nargs='*', default=['users', 'registrations', 'attendance'])
+    parser.add_argument('--where', action='append', default=[], metavar='TABLE=CONDITION',
+                        help="row filter, e.g. users=\"promoter = 'kerri_derri'\"")
+    parser.add_argument('--column', action='append', default=[], metavar='TABLE=COLUMN',
+                        help='high-water mark column for incremental exports (default: id); '
+                             'use an integer id, timestamps miss rows that commit late')
+    parser.add_argument('--out', default='data', help='output directory')
+    parser.add_argument('--format', choices=['csv.gz', 'parquet'], default='csv.gz')
+    parser.add_argument('--incremental', action='store_true', help='only export rows past the stored high-water mark')
+    parser.add_argument('--jobs', type=int, default=4, help='parallel connections')
+    args = parser.parse_args()
+
+    wheres = dict(item.split('=', 1) for item in args.where)
+    columns = dict(item.split('=', 1) for item in args.column)
+    os.makedirs(args.out, exist_ok=True)
+    state = load_state(args.out)
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [
+            pool.submit(
+                export_table,
+                table,
+                wheres.get(table),
+                columns.get(table, 'id'),
+                args.out,
+                args.format,
+                args.incremental,
+                state.get(f'{table}.{args.format}', {})
+            )
+            for table in args.tables
+        ]
+        for future in futures:
+            try:
+                table, rows, high, seen = future.result()
+            except Exception as e:
+                print(f"Error: {e}")
+                continue
+            key = f'{table}.{args.format}'
+            state[key] = {'column': columns.get(table, 'id'), 'value': high, 'where': wheres.get(table), 'seen': seen}
+            print(f"Exported {rows} rows from {table} (high-water mark {high})")
+
+    save_state(args.out, state)
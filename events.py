@@ -0,0 +1,108 @@
+import os
+import sys
+from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from cache import TTLCache
+from models import Session, Event, User
+import stats
+
+# How long a worker may keep using an event after it was opened or closed elsewhere
+EVENT_CACHE_TTL = float(os.getenv("EVENT_CACHE_TTL", "30"))
+
+_current = TTLCache(maxsize=1, ttl=EVENT_CACHE_TTL)
+
+
+def current_id(session=None):
+    """Id of the open event, 0 when none is open."""
+    event_id = _current.get("id")
+    if event_id is None:
+        session = session or Session()
+        event = session.query(Event.id).filter_by(status="open").order_by(Event.id.desc()).first()
+        event_id = event.id if event else 0
+        _current.set("id", event_id)
+    return event_id
+
+
+def open_event(name):
+    """Open a new event, or return None if one is already open."""
+    session = Session()
+    try:
+        if session.query(Event.id).filter_by(status="open").first():
+            return None
+        event = Event(name=name, status="open")
+        session.add(event)
+        try:
+            session.commit()
+        except IntegrityError:
+            # Opened concurrently by someone else (ux_events_one_open)
+            session.rollback()
+            return None
+        session.refresh(event)
+        session.expunge(event)
+        return event
+    finally:
+        session.close()
+        _current.clear()
+
+
+def close_event():
+    """Close the open event, freezing its counters and rollups; None if none is open."""
+    session = Session()
+    try:
+        event = session.query(Event.id).filter_by(status="open").order_by(Event.id.desc()).first()
+        if event is None:
+            return None
+        event_id = event.id
+    finally:
+        session.close()
+
+    # One last recount, after which the reconciler leaves this event alone
+    stats.reconcile([event_id])
+    session = Session()
+    try:
+        session.execute(
+            update(Event).where(Event.id == event_id, Event.status == "open")
+            .values(status="closed", closed_at=datetime.utcnow())
+        )
+        # Everyone has to be checked in again at the next event
+        session.execute(update(User).where(User.on_event.is_(True)).values(on_event=False))
+        session.commit()
+        event = session.get(Event, event_id)
+        session.expunge(event)
+        return event
+    finally:
+        session.close()
+        _current.clear()
+
+
+def recent(limit=10):
+    """Return [(event, registrations, attendance)] newest first."""
+    session = Session()
+    try:
+        events = session.query(Event).order_by(Event.id.desc()).limit(limit).all()
+        for event in events:
+            session.expunge(event)
+    finally:
+        session.close()
+    return [(event, stats.get("registrations", event.id), stats.get("attendance", event.id)) for event in events]
+
+
+def format_event(event, registrations, attendance):
+    status = "идет" if event.status == "open" else f"закрыт {event.closed_at:%d.%m %H:%M}"
+    return f"#{event.id} {event.name} ({status}): регистраций {registrations}, пришли {attendance}"
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if command == "open" and len(sys.argv) > 2:
+        event = open_event(" ".join(sys.argv[2:]))
+        print(f"Opened #{event.id} {event.name}" if event else "Another event is already open")
+    elif command == "close":
+        event = close_event()
+        print(f"Closed #{event.id} {event.name}" if event else "No event is open")
+    elif command == "list":
+        for row in recent():
+            print(format_event(*row))
+    else:
+        sys.exit(f"usage: {sys.argv[0]} open NAME|close|list")
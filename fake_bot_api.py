@@ -0,0 +1,163 @@
+"""Local stand-in for the Telegram Bot API, for load tests and broadcast dry runs.
+
+Point the bot at it with BOT_API_URL=http://127.0.0.1:8081/bot and
+BOT_FILE_URL=http://127.0.0.1:8081/file/bot.
+"""
+import json
+import time
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import parse_qs
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "underloft", "username": "underloft_bot"}
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8081), rate_limit=None, latency=0, blocked=(), files=None):
+        super().__init__(address, FakeBotAPIHandler)
+        # Requests per second above which calls get a 429 with retry_after
+        self.rate_limit = rate_limit
+        self.latency = latency
+        self.blocked = {int(chat_id) for chat_id in blocked}
+        # file_id -> bytes served by getFile and the file endpoint
+        self.files = files or {}
+        self.calls = Counter()
+        self.messages = []
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+        self._message_id = 0
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-bot-api", daemon=True).start()
+        return self
+
+    def throttled(self):
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            second = int(time.monotonic())
+            start, count = self._window
+            self._window = (second, count + 1) if start == second else (second, 1)
+            return self._window[1] > self.rate_limit
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send headers and body in one segment, otherwise delayed ACKs add ~40 ms to
+    # every keep-alive call and swamp what a benchmark is trying to measure
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _params(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("multipart/form-data"):
+            # Uploads: only the plain fields matter here
+            message = BytesParser().parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            return {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True).decode(errors="ignore")
+                for part in message.get_payload()
+                if not part.get_filename()
+            }
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def do_GET(self):
+        # /file/bot<token>/<file_path>
+        file_id = self.path.rsplit("/", 1)[-1]
+        self._reply(200, self.server.files.get(file_id, b""), "application/octet-stream")
+
+    def do_POST(self):
+        server = self.server
+        method = self.path.rsplit("/", 1)[-1]
+        params = self._params()
+        server.calls[method] += 1
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.throttled():
+            return self._reply(429, {
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            })
+        chat_id = params.get("chat_id")
+        if chat_id is not None and str(chat_id).lstrip("-").isdigit() and int(chat_id) in server.blocked:
+            return self._reply(403, {
+                "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"
+            })
+
+        result = self.result(method, params)
+        self._reply(200, {"ok": True, "result": result})
+
+    def result(self, method, params):
+        server = self.server
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            return {"user": {"id": int(params["user_id"]), "is_bot": False, "first_name": "user"}, "status": "member"}
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                    "file_size": len(server.files.get(params["file_id"], b"")), "file_path": params["file_id"]}
+        if method.startswith("send") or method.startswith("edit"):
+            message = {
+                "message_id": server.next_message_id(),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"},
+            }
+            if "text" in params:
+                message["text"] = params["text"]
+            if method == "sendPhoto":
+                message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": f"photo{message['message_id']}",
+                                     "width": 1080, "height": 1920}]
+            with server._lock:
+                server.messages.append((method, params))
+            return message
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rate-limit", type=int, default=None, help="requests per second before answering 429")
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before every answer")
+    parser.add_argument("--blocked", type=int, nargs="*", default=(), help="chat ids that blocked the bot")
+    args = parser.parse_args()
+
+    server = FakeBotAPI((args.host, args.port), args.rate_limit, args.latency, args.blocked)
+    print(f"Fake Bot API on {server.url}/bot<token>/<method>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
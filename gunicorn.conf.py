@@ -0,0 +1,23 @@
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:1612")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Import app.py once in the master so workers fork with warm caches
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.warmup()
+
+
+def post_fork(server, worker):
+    # Connections are per worker: models.py drops the pool inherited from the master
+    import app
+    try:
+        app.warm_pool()
+    except Exception:
+        # Not fatal: the worker connects on its first request instead
+        server.log.exception("database warmup failed in worker %s", worker.pid)
+
@@ -1,78 +1,144 @@
-import pandas as pd
+import os
+import time
+import argparse
+import dotenv
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import pandas as pd
 import seaborn as sns
-from datetime import datetime, timedelta
-import pytz
+from sqlalchemy import create_engine, text
+
+dotenv.load_dotenv()
 
 sns.set_style("whitegrid")
 plt.rcParams['figure.figsize'] = (12, 6)
 
-users = pd.read_csv('data/users.csv')
-attendance = pd.read_csv('data/attendance.csv')
-
-users['is_admin'] = users['is_admin'].astype(str).str.lower().map({
-    't': True,
-    'f': False
-})
-
-users = users[~users['is_admin']]
-attendance = attendance[attendance['user_id'].isin(users['user_id'])]
-
-attendance['timestamp'] = pd.to_datetime(attendance['timestamp'])
-attendance['timestamp'] = attendance['timestamp'] + timedelta(hours=3)
-
-attendance = attendance[attendance['timestamp'].dt.hour < 22]
-
-merged = pd.merge(attendance, users[['user_id', 'promoter']], on='user_id', how='left')
-
-promoter_attendance = merged.groupby(['promoter', 'ticket_type']).size().unstack(fill_value=0)
-
-print("Attendance by Promoter and Ticket Type:")
-print(promoter_attendance)
-
-ticket_counts = attendance['ticket_type'].value_counts()
-plt.figure(figsize=(8, 8))
-plt.pie(ticket_counts, labels=ticket_counts.index, autopct='%1.1f%%', startangle=90)
-plt.title('Proportion of Ticket Types')
-plt.show()
-
-hourly_attendance = attendance.set_index('timestamp').resample('H').size()
-
-moving_avg = hourly_attendance.rolling(window=3, center=True).mean()
-
-plt.figure()
-moving_avg.plot(label='3-hour Moving Average')
-plt.title('Attendance Over Time (3-hour Moving Average)')
-plt.xlabel('Time')
-plt.ylabel('Number of Attendees')
-plt.legend()
-plt.show()
-
-attendance['hour'] = attendance['timestamp'].dt.hour
-hourly_dist = attendance['hour'].value_counts().sort_index()
-plt.figure()
-hourly_dist.plot(kind='bar')
-plt.title('Attendance by Hour of Day')
-plt.xlabel('Hour')
-plt.ylabel('Number of Attendees')
-plt.xticks(rotation=0)
-plt.show()
-
-top_promoters = merged['promoter'].value_counts().head(10)
-plt.figure()
-top_promoters.plot(kind='barh')
-plt.title('Top 10 Promoters by Number of Attendees')
-plt.xlabel('Number of Attendees')
-plt.ylabel('Promoter')
-plt.show()
-
-top_promoter_names = top_promoters.index[:5]
-promoter_ticket_dist = merged[merged['promoter'].isin(top_promoter_names)]
-promoter_ticket_dist = promoter_ticket_dist.groupby(['promoter', 'ticket_type']).size().unstack()
-
-promoter_ticket_dist.plot(kind='bar', stacked=True)
-plt.title('Ticket Type Distribution by Top Promoters')
-plt.xlabel('Promoter')
-plt.ylabel('Number of Attendees')
-plt.legend(title='Ticket Type')
-plt.show()
\ No newline at end of file
+# Everything the report needs for one event, aggregated in Postgres to
+# (hour, promoter, ticket_type); ix_attendance_event_id_timestamp limits the scan to the event
+ATTENDANCE_QUERY = """
+WITH shifted AS (
+    SELECT attendance.timestamp + make_interval(hours => :tz_offset) AS ts,
+           attendance.ticket_type,
+           users.promoter
+    FROM attendance
+    JOIN users ON users.user_id = attendance.user_id
+    WHERE attendance.event_id = :event_id AND NOT coalesce(users.is_admin, false)
+)
+SELECT date_trunc('hour', ts) AS hour, promoter, ticket_type, count(*) AS attendees
+FROM shifted
+WHERE :max_hour IS NULL OR extract(hour FROM ts) < :max_hour
+GROUP BY 1, 2, 3
+"""
+
+ROLLUP_QUERY = (
+    "SELECT promoter, ticket_type, attended FROM promoter_stats WHERE event_id = :event_id AND ticket_type <> ''"
+)
+LATEST_EVENT_QUERY = "SELECT coalesce(max(id), 0) FROM events"
+
+
+def save(fig, output, name, charts):
+    path = os.path.join(output, f"{name}.png")
+    fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+    charts.append(f"{name}.png")
+
+
+def build_report(engine, output, event_id=None, tz_offset=3, max_hour=None, from_rollup=False):
+    os.makedirs(output, exist_ok=True)
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        if event_id is None:
+            event_id = conn.execute(text(LATEST_EVENT_QUERY)).scalar()
+        grouped = pd.read_sql(text(ATTENDANCE_QUERY), conn, params={
+            "event_id": event_id, "tz_offset": tz_offset, "max_hour": max_hour
+        })
+        rollup = pd.read_sql(text(ROLLUP_QUERY), conn, params={"event_id": event_id}) if from_rollup else None
+    print(f"Event {event_id}: queried {len(grouped)} aggregate rows in {time.perf_counter() - started:.2f}s")
+
+    grouped["hour"] = pd.to_datetime(grouped["hour"])
+    charts = []
+
+    if rollup is not None:
+        promoter_attendance = rollup.pivot(index='promoter', columns='ticket_type', values='attended').fillna(0).astype(int)
+    else:
+        promoter_attendance = grouped.pivot_table(
+            index='promoter', columns='ticket_type', values='attendees', aggfunc='sum', fill_value=0
+        )
+    print("Attendance by Promoter and Ticket Type:")
+    print(promoter_attendance)
+    promoter_attendance.to_csv(os.path.join(output, "promoter_attendance.csv"))
+
+    ticket_counts = grouped.groupby('ticket_type')['attendees'].sum()
+    fig = plt.figure(figsize=(8, 8))
+    plt.pie(ticket_counts, labels=ticket_counts.index, autopct='%1.1f%%', startangle=90)
+    plt.title('Proportion of Ticket Types')
+    save(fig, output, "ticket_types", charts)
+
+    hourly_attendance = grouped.groupby('hour')['attendees'].sum().resample('h').sum()
+    moving_avg = hourly_attendance.rolling(window=3, center=True).mean()
+    fig = plt.figure()
+    moving_avg.plot(label='3-hour Moving Average')
+    plt.title('Attendance Over Time (3-hour Moving Average)')
+    plt.xlabel('Time')
+    plt.ylabel('Number of Attendees')
+    plt.legend()
+    save(fig, output, "attendance_over_time", charts)
+
+    hourly_dist = grouped.groupby(grouped['hour'].dt.hour)['attendees'].sum().sort_index()
+    fig = plt.figure()
+    hourly_dist.plot(kind='bar')
+    plt.title('Attendance by Hour of Day')
+    plt.xlabel('Hour')
+    plt.ylabel('Number of Attendees')
+    plt.xticks(rotation=0)
+    save(fig, output, "attendance_by_hour", charts)
+
+    top_promoters = grouped.groupby('promoter')['attendees'].sum().sort_values(ascending=False).head(10)
+    fig = plt.figure()
+    top_promoters.plot(kind='barh')
+    plt.title('Top 10 Promoters by Number of Attendees')
+    plt.xlabel('Number of Attendees')
+    plt.ylabel('Promoter')
+    save(fig, output, "top_promoters", charts)
+
+    promoter_ticket_dist = promoter_attendance.loc[
+        promoter_attendance.index.intersection(top_promoters.index[:5])
+    ]
+    ax = promoter_ticket_dist.plot(kind='bar', stacked=True)
+    plt.title('Ticket Type Distribution by Top Promoters')
+    plt.xlabel('Promoter')
+    plt.ylabel('Number of Attendees')
+    plt.legend(title='Ticket Type')
+    save(ax.figure, output, "top_promoters_ticket_types", charts)
+
+    with open(os.path.join(output, "index.html"), "w") as f:
+        f.write("<html><head><meta charset='utf-8'><title>underloft report</title></head><body>\n")
+        f.write("<h2>Attendance by Promoter and Ticket Type</h2>\n")
+        f.write(promoter_attendance.to_html())
+        for chart in charts:
+            f.write(f"\n<p><img src='{chart}'></p>")
+        f.write("\n</body></html>\n")
+
+    print(f"Report written to {output} in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render attendance analytics to PNG/HTML")
+    parser.add_argument("--out", default="data/report", help="output directory")
+    parser.add_argument("--tz-offset", type=int, default=3, help="hours added to UTC timestamps")
+    parser.add_argument("--event", type=int, default=None,
+                        help="event id, 0 for check-ins recorded outside events (default: the latest event)")
+    parser.add_argument("--max-hour", type=int, default=None, help="ignore check-ins at or after this local hour")
+    parser.add_argument("--from-rollup", action="store_true",
+                        help="take the promoter x ticket type table from promoter_stats")
+    args = parser.parse_args()
+
+    build_report(
+        create_engine(os.getenv("DATABASE_URL")),
+        args.out,
+        event_id=args.event,
+        tz_offset=args.tz_offset,
+        max_hour=args.max_hour,
+        from_rollup=args.from_rollup
+    )
@@ -0,0 +1,76 @@
+import os
+import json
+import threading
+import tempfile
+from telegram.error import BadRequest
+
+MEDIA_REGISTRY = os.getenv("MEDIA_REGISTRY", "img/file_ids.json")
+
+_lock = threading.Lock()
+_registry = None
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def _load():
+    global _registry
+    if _registry is None:
+        try:
+            with open(MEDIA_REGISTRY) as f:
+                _registry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            _registry = {}
+    return _registry
+
+
+def _save():
+    # Other workers may have recorded uploads meanwhile, keep theirs too
+    try:
+        with open(MEDIA_REGISTRY) as f:
+            merged = json.load(f)
+    except (FileNotFoundError, ValueError):
+        merged = {}
+    merged.update(_registry)
+    directory = os.path.dirname(MEDIA_REGISTRY) or "."
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+        json.dump(merged, f, indent=2)
+    os.replace(f.name, MEDIA_REGISTRY)
+
+
+def get_file_id(path):
+    """Return the Telegram file_id recorded for an unchanged file, if any."""
+    with _lock:
+        entry = _load().get(path)
+    if entry and entry["stamp"] == _stamp(path):
+        return entry["file_id"]
+    return None
+
+
+def remember(path, file_id):
+    with _lock:
+        _load()[path] = {"file_id": file_id, "stamp": _stamp(path)}
+        _save()
+
+
+def forget(path):
+    with _lock:
+        if _load().pop(path, None) is not None:
+            _save()
+
+
+def send_photo(bot, chat_id, path, **kwargs):
+    """Send a photo from img/ by file_id, uploading it only the first time."""
+    file_id = get_file_id(path)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest:
+            forget(path)
+
+    with open(path, 'rb') as photo:
+        message = bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    remember(path, message.photo[-1].file_id)
+    return message
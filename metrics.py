@@ -0,0 +1,227 @@
+"""In-process metrics exposed in the Prometheus text format at /metrics.
+
+Every gunicorn worker keeps its own values, each sample carries a `worker`
+label (the pid) so scrapes from different workers can be told apart.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Log updates slower than this (milliseconds) with a per-stage breakdown, 0 disables it
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "0"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+_callbacks = []
+_local = threading.local()
+
+
+def _format_labels(labels):
+    labels = dict(labels, worker=os.getpid())
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(labels), value) for labels, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self):
+        result = []
+        with self._lock:
+            items = [(dict(labels), list(state)) for labels, state in self._values.items()]
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), state[:-1]):
+                cumulative += count
+                result.append((f"{self.name}_bucket", dict(labels, le=bound), cumulative))
+            result.append((f"{self.name}_sum", labels, state[-1]))
+            result.append((f"{self.name}_count", labels, cumulative))
+        return result
+
+
+def register_callback(name, kind, documentation, function):
+    """Expose a value computed at scrape time; function returns a number or [(labels, value)]."""
+    _callbacks.append((name, kind, documentation, function))
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name, kind, documentation, function in _callbacks:
+        try:
+            values = function()
+        except Exception:
+            logger.exception("metrics callback %s failed", name)
+            continue
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in (values if isinstance(values, list) else [({}, values)]):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+handler_seconds = Histogram("handler_seconds", "Time spent in each update handler")
+handler_errors = Counter("handler_errors_total", "Exceptions raised by update handlers")
+handlers_in_flight = Gauge("handlers_in_flight", "Handlers currently running")
+function_seconds = Histogram("function_seconds", "Time spent in instrumented helper functions")
+db_query_seconds = Histogram("db_query_seconds", "Time spent executing SQL statements",
+                             buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+db_errors = Counter("db_errors_total", "SQL statements that raised")
+bot_api_seconds = Histogram("bot_api_seconds", "Time spent in Telegram Bot API calls")
+bot_api_errors = Counter("bot_api_errors_total", "Telegram Bot API calls that raised")
+bot_api_inline = Counter("bot_api_inline_total", "Bot API calls answered in the webhook response")
+updates_in_flight = Gauge("updates_in_flight", "Updates currently being processed")
+
+
+# Per-update stage accounting, used for the slow-update log
+
+def add_stage(stage, seconds):
+    stages = getattr(_local, "stages", None)
+    if stages is not None:
+        total, count = stages.get(stage, (0.0, 0))
+        stages[stage] = (total + seconds, count + 1)
+
+
+class track_update:
+    """Context manager around processing one update."""
+
+    def __init__(self, update):
+        self.update = update
+
+    def __enter__(self):
+        _local.stages = {}
+        self.started = time.perf_counter()
+        updates_in_flight.inc()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        updates_in_flight.dec()
+        stages, _local.stages = _local.stages, None
+        if SLOW_UPDATE_MS and elapsed * 1000 >= SLOW_UPDATE_MS:
+            breakdown = " ".join(
+                f"{stage}={total * 1000:.1f}ms/{count}" for stage, (total, count) in sorted(stages.items())
+            )
+            logger.warning("slow update %s: %.1fms %s", self.update.update_id, elapsed * 1000, breakdown)
+
+
+def instrument_handler(callback):
+    name = callback.__name__
+
+    @wraps(callback)
+    def wrapper(update, context):
+        started = time.perf_counter()
+        handlers_in_flight.inc(handler=name)
+        try:
+            return callback(update, context)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handlers_in_flight.dec(handler=name)
+            handler_seconds.observe(elapsed, handler=name)
+            add_stage(f"handler:{name}", elapsed)
+
+    return wrapper
+
+
+def timed(function):
+    name = function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            function_seconds.observe(time.perf_counter() - started, function=name)
+
+    return wrapper
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_query_seconds.observe(elapsed, operation=operation)
+        add_stage("db", elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            started.pop()
+        db_errors.inc()
+
+
+def observe_bot_call(method, seconds, failed=False):
+    bot_api_seconds.observe(seconds, method=method)
+    if failed:
+        bot_api_errors.inc(method=method)
+    add_stage("bot", seconds)
@@ -1,26 +1,229 @@
 import os
+import sys
+import re
+import json
+import argparse
 import dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, inspect, text
 
 dotenv.load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-
-with engine.connect() as conn:
-    # Disable transaction
-    conn.execution_options(isolation_level="AUTOCOMMIT") 
-    
-    # Convert columns to VARCHAR while preserving data
-    migration_queries = [
-        "ALTER TABLE users ALTER COLUMN user_id TYPE VARCHAR USING user_id::VARCHAR",
-        "ALTER TABLE registrations ALTER COLUMN user_id TYPE VARCHAR USING user_id::VARCHAR",
-        "ALTER TABLE attendance ALTER COLUMN user_id TYPE VARCHAR USING user_id::VARCHAR"
-    ]
-    
-    for query in migration_queries:
+
+# Each migration is applied once, in order, and recorded in schema_version.
+# "explain" lists the queries whose plans the migration is expected to change.
+# "concurrently" builds its indexes without blocking writes on Postgres, one
+# statement at a time outside a transaction.
+MIGRATIONS = [
+    {
+        "version": 1,
+        "description": "store user_id columns as VARCHAR",
+        "postgresql_only": True,
+        "statements": [
+            "ALTER TABLE users ALTER COLUMN user_id TYPE VARCHAR USING user_id::VARCHAR",
+            "ALTER TABLE registrations ALTER COLUMN user_id TYPE VARCHAR USING user_id::VARCHAR",
+            "ALTER TABLE attendance ALTER COLUMN user_id TYPE VARCHAR USING user_id::VARCHAR",
+        ],
+    },
+    {
+        "version": 2,
+        "description": "index telegram_tag lookups, promoter and attendance",
+        "concurrently": True,
+        "statements": [
+            "CREATE INDEX IF NOT EXISTS ix_users_telegram_tag_lower ON users (lower(telegram_tag))",
+            "CREATE INDEX IF NOT EXISTS ix_users_promoter ON users (promoter)",
+            "CREATE INDEX IF NOT EXISTS ix_attendance_user_id ON attendance (user_id)",
+            "CREATE INDEX IF NOT EXISTS ix_attendance_timestamp ON attendance (timestamp)",
+        ],
+        "explain": [
+            "SELECT * FROM users WHERE lower(telegram_tag) = lower('underloft') LIMIT 1",
+            "SELECT count(*) FROM users WHERE promoter = 'underloft'",
+            "SELECT count(*) FROM users JOIN attendance ON users.user_id = attendance.user_id "
+            "WHERE users.promoter = 'underloft'",
+            "SELECT count(*) FROM attendance WHERE timestamp >= now() - interval '1 day'",
+        ],
+    },
+    {
+        "version": 3,
+        "description": "record the ticket type issued to each user",
+        "postgresql_only": True,
+        "statements": [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS ticket_type VARCHAR",
+        ],
+    },
+    {
+        "version": 4,
+        "description": "events, with event_id on attendance, registrations, counters and rollups",
+        "postgresql_only": True,
+        "statements": [
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id SERIAL PRIMARY KEY, name VARCHAR NOT NULL, status VARCHAR NOT NULL DEFAULT 'open', "
+            "opened_at TIMESTAMP, closed_at TIMESTAMP)",
+            # Existing rows predate events and stay under event 0
+            "ALTER TABLE registrations ADD COLUMN IF NOT EXISTS event_id INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE attendance ADD COLUMN IF NOT EXISTS event_id INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE stats ADD COLUMN IF NOT EXISTS event_id INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE stats DROP CONSTRAINT IF EXISTS stats_pkey",
+            "ALTER TABLE stats ADD PRIMARY KEY (name, event_id)",
+            "ALTER TABLE promoter_stats ADD COLUMN IF NOT EXISTS event_id INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE promoter_stats DROP CONSTRAINT IF EXISTS promoter_stats_pkey",
+            "ALTER TABLE promoter_stats ADD PRIMARY KEY (event_id, promoter, ticket_type)",
+        ],
+    },
+    {
+        "version": 5,
+        "description": "index attendance and registrations by event",
+        "concurrently": True,
+        "statements": [
+            "CREATE INDEX IF NOT EXISTS ix_attendance_event_id_timestamp ON attendance (event_id, timestamp)",
+            "CREATE INDEX IF NOT EXISTS ix_registrations_event_id ON registrations (event_id)",
+        ],
+        "explain": [
+            "SELECT count(*) FROM attendance WHERE event_id = 0",
+            "SELECT date_trunc('hour', timestamp), count(*) FROM attendance WHERE event_id = 0 GROUP BY 1",
+            "SELECT count(*) FROM registrations WHERE event_id = 0",
+        ],
+    },
+    {
+        "version": 6,
+        "description": "record which runner owns a broadcast job",
+        "postgresql_only": True,
+        "statements": [
+            "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS owner VARCHAR",
+        ],
+    },
+    {
+        "version": 7,
+        "description": "allow at most one open event",
+        # Fails while more than one event is open: close the extras first
+        "statements": [
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_events_one_open ON events (status) WHERE status = 'open'",
+        ],
+    },
+]
+
+
+def ensure_version_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR, "
+            "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        ))
+
+
+def applied_versions(engine):
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+
+INDEX_NAME = re.compile(r"CREATE (?:UNIQUE )?INDEX (?:CONCURRENTLY )?IF NOT EXISTS (\w+)")
+
+
+def create_indexes_concurrently(engine, statements):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for statement in statements:
+            name = INDEX_NAME.match(statement).group(1)
+            # An interrupted CONCURRENTLY build leaves an invalid index behind,
+            # which IF NOT EXISTS would then skip
+            invalid = conn.execute(text(
+                "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"
+            ), {"name": name}).scalar()
+            if invalid:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(statement))
+
+
+def explain(engine, query):
+    """Return (execution time in ms, top plan node) for a query, Postgres only."""
+    with engine.connect() as conn:
+        plan = conn.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Execution Time"], plan[0]["Plan"]["Node Type"]
+
+
+def report_explain(engine, queries, label):
+    timings = {}
+    for query in queries:
         try:
-            conn.execute(text(query))
-            print(f"Success: {query}")
+            timings[query] = explain(engine, query)
+            print(f"  {label}: {timings[query][0]:.3f} ms ({timings[query][1]})  {query}")
         except Exception as e:
-            print(f"Error executing {query}: {str(e)}")
\ No newline at end of file
+            print(f"  {label}: EXPLAIN failed ({e})  {query}")
+    return timings
+
+
+def run(engine, dry_run=False):
+    is_postgres = engine.dialect.name == "postgresql"
+    if not dry_run:
+        ensure_version_table(engine)
+        done = applied_versions(engine)
+    elif inspect(engine).has_table("schema_version"):
+        done = applied_versions(engine)
+    else:
+        # Nothing has been applied yet, and a dry run creates nothing
+        done = set()
+    pending = [m for m in MIGRATIONS if m["version"] not in done]
+
+    if not pending:
+        print("Schema is up to date")
+        return 0
+
+    for migration in pending:
+        version = migration["version"]
+        print(f"Migration {version}: {migration['description']}")
+        queries = migration.get("explain", []) if is_postgres else []
+
+        if migration.get("postgresql_only") and not is_postgres:
+            statements = []
+            print(f"  skipped on {engine.dialect.name}")
+        else:
+            statements = migration["statements"]
+        concurrently = migration.get("concurrently") and is_postgres
+        if concurrently:
+            statements = [statement.replace(" INDEX ", " INDEX CONCURRENTLY ", 1) for statement in statements]
+        for statement in statements:
+            print(f"  {statement}")
+
+        before = report_explain(engine, queries, "before")
+        if dry_run:
+            continue
+
+        try:
+            if concurrently:
+                create_indexes_concurrently(engine, statements)
+            with engine.begin() as conn:
+                if not concurrently:
+                    for statement in statements:
+                        conn.execute(text(statement))
+                conn.execute(
+                    text("INSERT INTO schema_version (version, description) VALUES (:version, :description)"),
+                    {"version": version, "description": migration["description"]},
+                )
+        except Exception as e:
+            print(f"Error applying migration {version}: {str(e)}")
+            return 1
+        print(f"Success: migration {version}")
+
+        after = report_explain(engine, queries, "after")
+        for query in queries:
+            if query in before and query in after:
+                print(f"  {before[query][0]:.3f} ms -> {after[query][0]:.3f} ms  {query}")
+
+    if dry_run:
+        print("Dry run: nothing was applied")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--dry-run", action="store_true", help="print pending migrations without applying them")
+    parser.add_argument("--no-create", action="store_true", help="skip creating missing tables from the models")
+    args = parser.parse_args()
+
+    if not args.dry_run and not args.no_create:
+        from models import init_db
+        init_db()
+    sys.exit(run(create_engine(DATABASE_URL), dry_run=args.dry_run))
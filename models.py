@@ -0,0 +1,244 @@
+import os
+import time
+import threading
+import dotenv
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Text, Float, Boolean, DateTime, Index, func, text
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, NullPool
+from datetime import datetime
+import metrics
+
+dotenv.load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+# "pgbouncer" leaves pooling to PgBouncer in transaction mode: no client-side pool,
+# so no connection (and no session state) outlives a transaction
+DB_POOL_MODE = os.getenv("DB_POOL_MODE", "queue")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# Seconds the door scanner waits on the database before falling back to the replica
+DOOR_DB_TIMEOUT = int(os.getenv("DOOR_DB_TIMEOUT", "2"))
+
+# Upper bounds (seconds) of the checkout wait histogram
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class PoolWaitStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.failed = 0
+        self.buckets = [0] * (len(POOL_WAIT_BUCKETS) + 1)
+        self._lock = threading.Lock()
+
+    def record(self, wait, failed=False):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.failed += failed
+            for i, bound in enumerate(POOL_WAIT_BUCKETS):
+                if wait <= bound:
+                    self.buckets[i] += 1
+                    break
+            else:
+                self.buckets[-1] += 1
+
+    def as_dict(self, engine):
+        pool = engine.pool
+        return {
+            "mode": DB_POOL_MODE,
+            "checked_out": pool.checkedout() if isinstance(pool, QueuePool) else None,
+            "size": pool.size() if isinstance(pool, QueuePool) else None,
+            "checkouts": self.checkouts,
+            "failed": self.failed,
+            "avg_wait_ms": self.total_wait / self.checkouts * 1000 if self.checkouts else 0,
+            "max_wait_ms": self.max_wait * 1000,
+            "wait_buckets": dict(zip([*map(str, POOL_WAIT_BUCKETS), "+Inf"], self.buckets)),
+        }
+
+
+pool_stats = PoolWaitStats()
+door_pool_stats = PoolWaitStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+    # A class attribute, so that it survives the pool being recreated on dispose()
+    stats = pool_stats
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.stats.record(time.perf_counter() - started, failed=True)
+            raise
+        self.stats.record(time.perf_counter() - started)
+        return connection
+
+
+class DoorQueuePool(TimedQueuePool):
+    stats = door_pool_stats
+
+
+def make_engine(url=DATABASE_URL, pool_size=DB_POOL_SIZE, pool_timeout=DB_POOL_TIMEOUT, connect_args=None,
+                poolclass=TimedQueuePool):
+    if url.startswith("sqlite"):
+        return create_engine(url)
+    connect_args = connect_args or {}
+    if DB_POOL_MODE == "pgbouncer":
+        return create_engine(url, poolclass=NullPool, connect_args=connect_args)
+    return create_engine(
+        url,
+        poolclass=poolclass,
+        pool_size=pool_size,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=pool_timeout,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+
+def door_connect_args(timeout=DOOR_DB_TIMEOUT):
+    """libpq settings that turn a dead venue network into an error within timeout seconds."""
+    args = {
+        "connect_timeout": timeout,
+        # Bounds pre-ping and queries on a connection whose packets stopped being acknowledged
+        "tcp_user_timeout": timeout * 1000,
+    }
+    if DB_POOL_MODE != "pgbouncer":
+        # PgBouncer rejects startup options it does not know
+        args["options"] = f"-c statement_timeout={timeout * 1000}"
+    return args
+
+
+engine = make_engine()
+metrics.instrument_engine(engine)
+# Separate small pool for the door scanner, so a check-in never waits out the default timeouts
+door_engine = make_engine(pool_size=2, pool_timeout=DOOR_DB_TIMEOUT, connect_args=door_connect_args(),
+                          poolclass=DoorQueuePool)
+metrics.instrument_engine(door_engine)
+
+
+def _after_fork():
+    # Forked children (gunicorn workers, render processes) must not reuse the
+    # parent's sockets: drop the inherited pool without closing it under the parent
+    engine.dispose(close=False)
+    door_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+Base = declarative_base()
+# Thread-local session: every update gets one session, removed once it is processed
+Session = scoped_session(sessionmaker(bind=engine))
+DoorSession = scoped_session(sessionmaker(bind=door_engine))
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, unique=True)
+    phone = Column(String)
+    telegram_tag = Column(String, nullable=True)
+    has_ticket = Column(Boolean, default=False)
+    ticket_type = Column(String, nullable=True)
+    on_event = Column(Boolean, default=False)
+    is_admin = Column(Boolean, default=False)
+    is_promoter = Column(Boolean, default=False)
+    promoter = Column(String, nullable=True, index=True)
+
+    __table_args__ = (
+        Index('ix_users_telegram_tag_lower', func.lower(telegram_tag)),
+    )
+
+class Event(Base):
+    __tablename__ = 'events'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    # At most one event is 'open'; counters and rollups of 'closed' events are frozen
+    status = Column(String, nullable=False, default='open')
+    opened_at = Column(DateTime, default=datetime.utcnow)
+    closed_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        # Enforces the single open event even when two admins open one at once
+        Index('ux_events_one_open', status, unique=True,
+              postgresql_where=text("status = 'open'"), sqlite_where=text("status = 'open'")),
+    )
+
+# event_id 0 holds rows recorded while no event was open (and everything from
+# before events existed)
+
+class Registration(Base):
+    __tablename__ = 'registrations'
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    user_id = Column(String)
+    phone = Column(String)
+    event_id = Column(Integer, nullable=False, default=0, index=True)
+
+class Attendance(Base):
+    __tablename__ = 'attendance'
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    user_id = Column(String, index=True)
+    phone = Column(String)
+    ticket_type = Column(String)
+    event_id = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_attendance_event_id_timestamp', event_id, timestamp),
+    )
+
+class Stat(Base):
+    __tablename__ = 'stats'
+    name = Column(String, primary_key=True)
+    # "users" is only kept under 0, per-event counters under their event
+    event_id = Column(Integer, primary_key=True, default=0)
+    value = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PromoterStat(Base):
+    __tablename__ = 'promoter_stats'
+    # Invites are not tied to an event and are only counted under event 0
+    event_id = Column(Integer, primary_key=True, default=0)
+    # ticket_type '' holds the promoter's totals, other rows count check-ins per ticket type
+    promoter = Column(String, primary_key=True)
+    ticket_type = Column(String, primary_key=True, default='')
+    invited = Column(Integer, nullable=False, default=0)
+    attended = Column(Integer, nullable=False, default=0)
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    created_by = Column(String)
+    status = Column(String, nullable=False, default='pending')
+    # Token of the runner that claimed the job; only it may write progress
+    owner = Column(String, nullable=True)
+    # users.id of the last recipient whose chunk was fully processed
+    checkpoint = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    elapsed = Column(Float, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+def init_db():
+    """Create missing tables; run explicitly (python models.py or migrate.py), never on import."""
+    Base.metadata.create_all(engine)
+
+if __name__ == "__main__":
+    init_db()
+    print("Schema created")
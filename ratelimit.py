@@ -0,0 +1,98 @@
+import threading
+import time
+from cache import TTLCache
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available."""
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+
+class FloodControl:
+    """Per-user, per-handler token buckets plus a cap on concurrently handled updates.
+
+    limits maps a handler kind to (rate per second, burst); "default" covers the rest.
+    """
+
+    def __init__(self, limits, max_concurrent, acquire_timeout=1.0, max_users=100000):
+        self.limits = limits
+        self.acquire_timeout = acquire_timeout
+        self.throttled = {}
+        self.overloaded = 0
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        # A bucket that expires is recreated full, so keep them well past refill time
+        idle = max(600, *(burst / rate for rate, burst in limits.values()))
+        self._buckets = TTLCache(maxsize=max_users, ttl=idle)
+        self._lock = threading.Lock()
+
+    def allow(self, user_id, kind):
+        if kind not in self.limits:
+            kind = "default"
+        key = (user_id, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[kind]
+            self._buckets.add(key, TokenBucket(rate, capacity=burst))
+            bucket = self._buckets.get(key)
+        if bucket.try_acquire():
+            return True
+        with self._lock:
+            self.throttled[kind] = self.throttled.get(kind, 0) + 1
+        return False
+
+    def enter(self):
+        if self._slots.acquire(timeout=self.acquire_timeout):
+            return True
+        with self._lock:
+            self.overloaded += 1
+        return False
+
+    def leave(self):
+        self._slots.release()
+
+    def stats(self):
+        return {"throttled": dict(self.throttled), "overloaded": self.overloaded}
+
+
+def parse_limits(spec):
+    """Parse "start=0.2/3,default=2/10" into {"start": (0.2, 3), "default": (2.0, 10.0)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        kind, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        limits[kind] = (float(rate), float(burst or rate))
+    return limits
@@ -0,0 +1,385 @@
+"""Local replica of ticket holders so the door can keep checking guests in offline.
+
+`python replica.py sync` writes every user (admins included, so door staff are
+still recognised) into a memory-mapped open-addressing hash table keyed by
+Telegram user id. Offline check-ins are appended to a journal, which
+`python replica.py reconcile` (or the background reconciler) replays into
+users.on_event and Attendance once the database is reachable again.
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import fcntl
+import struct
+import tempfile
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import update, insert
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+from models import Session, User, Attendance
+import stats
+import events
+
+logger = logging.getLogger(__name__)
+
+# "online" checks every scan against the database, "offline" only against the
+# replica, "auto" falls back to the replica when the database is unreachable
+CHECK_IN_MODE = os.getenv("CHECK_IN_MODE", "online")
+REPLICA_PATH = os.getenv("REPLICA_PATH", "data/tickets.replica")
+REPLICA_JOURNAL = os.getenv("REPLICA_JOURNAL", "data/checkins.jsonl")
+REPLICA_RECONCILE_INTERVAL = float(os.getenv("REPLICA_RECONCILE_INTERVAL", "30"))
+REPLICA_SYNC_INTERVAL = float(os.getenv("REPLICA_SYNC_INTERVAL", "300"))
+# After the database fails, scans stay on the replica this long before trying it again
+CHECK_IN_BREAKER_SECONDS = float(os.getenv("CHECK_IN_BREAKER_SECONDS", "30"))
+
+# What a lost database looks like: refused or timed out connections and queries,
+# or no pooled connection freed up in time
+DB_UNREACHABLE = (DBAPIError, PoolTimeoutError)
+
+MAGIC = b"ULRP"
+VERSION = 2
+# magic, version, slot count (a power of two), holder count, synced at (unix time), event id
+HEADER = struct.Struct("<4sHxxQQdQ")
+# user id (0 marks an empty slot), flags, ticket type, phone, telegram tag, promoter
+SLOT = struct.Struct("<QB15s16s32s32s")
+HAS_TICKET, ON_EVENT, IS_ADMIN = 1, 2, 4
+
+Holder = namedtuple("Holder", "user_id has_ticket on_event is_admin ticket_type phone telegram_tag promoter")
+
+
+def _hash(key, mask):
+    # Fibonacci hashing spreads sequential ids across the table
+    return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32 & mask
+
+
+def _text(value, size):
+    return (value or "").encode()[:size]
+
+
+def _untext(value):
+    return value.rstrip(b"\0").decode(errors="replace") or None
+
+
+def write_snapshot(path, holders, event_id=0):
+    """Write holders (Holder tuples) of an event to path atomically."""
+    holders = [holder for holder in holders if str(holder.user_id).isdigit() and int(holder.user_id)]
+    capacity = 1
+    while capacity < max(len(holders) * 2, 8):
+        capacity *= 2
+    mask = capacity - 1
+
+    table = bytearray(HEADER.size + capacity * SLOT.size)
+    HEADER.pack_into(table, 0, MAGIC, VERSION, capacity, len(holders), time.time(), event_id)
+    for holder in holders:
+        key = int(holder.user_id)
+        index = _hash(key, mask)
+        while struct.unpack_from("<Q", table, HEADER.size + index * SLOT.size)[0]:
+            index = (index + 1) & mask
+        SLOT.pack_into(
+            table, HEADER.size + index * SLOT.size, key,
+            HAS_TICKET * bool(holder.has_ticket) | ON_EVENT * bool(holder.on_event) | IS_ADMIN * bool(holder.is_admin),
+            _text(holder.ticket_type, 15), _text(holder.phone, 16),
+            _text(holder.telegram_tag, 32), _text(holder.promoter, 32),
+        )
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # A fresh file every time: truncating one that was already renamed into place
+    # would pull the pages out from under the workers that have it mapped
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers holding the old mapping keep it until they notice the new inode
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(holders)
+
+
+class Snapshot:
+    """Read-only view of the replica file, reopened whenever sync replaces it."""
+
+    def __init__(self, path=REPLICA_PATH):
+        self.path = path
+        self._mm = None
+        self._inode = None
+        self._lock = threading.Lock()
+
+    def _table(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+        if inode != self._inode:
+            with self._lock:
+                if inode != self._inode:
+                    with open(self.path, "rb") as f:
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    magic, version = HEADER.unpack_from(mm)[:2]
+                    if (magic, version) != (MAGIC, VERSION):
+                        raise ValueError(f"{self.path} is not a version {VERSION} replica")
+                    self._mm, self._inode = mm, inode
+        return self._mm
+
+    def lookup(self, user_id):
+        mm = self._table()
+        # 0 marks an empty slot, and is never a Telegram user id
+        if mm is None or not str(user_id).isdigit() or not int(user_id):
+            return None
+        capacity = HEADER.unpack_from(mm)[2]
+        key, mask = int(user_id), capacity - 1
+        index = _hash(key, mask)
+        while True:
+            slot = SLOT.unpack_from(mm, HEADER.size + index * SLOT.size)
+            if slot[0] == key:
+                flags = slot[1]
+                return Holder(
+                    str(key), bool(flags & HAS_TICKET), bool(flags & ON_EVENT), bool(flags & IS_ADMIN),
+                    *map(_untext, slot[2:])
+                )
+            if slot[0] == 0:
+                return None
+            index = (index + 1) & mask
+
+    def info(self):
+        mm = self._table()
+        if mm is None:
+            return None
+        _, _, capacity, count, synced_at, event_id = HEADER.unpack_from(mm)
+        return {"holders": count, "slots": capacity, "synced_at": synced_at, "event_id": event_id}
+
+
+class Journal:
+    """Append-only log of offline check-ins, shared by every worker through flock."""
+
+    def __init__(self, path=REPLICA_JOURNAL):
+        self.path = path
+        self.synced_path = f"{path}.synced"
+        self._admitted = set()
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _catch_up(self, f):
+        f.seek(self._offset)
+        for line in iter(f.readline, b""):
+            if not line.endswith(b"\n"):
+                break
+            row = json.loads(line)
+            self._admitted.add((row.get("event_id", 0), row["user_id"]))
+            self._offset += len(line)
+
+    def admit(self, row):
+        """Append row unless its user is already in the journal; return whether it was."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(self.path, "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._catch_up(f)
+            key = (row["event_id"], row["user_id"])
+            if key in self._admitted:
+                return False
+            line = json.dumps(row, ensure_ascii=False).encode() + b"\n"
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+            self._admitted.add(key)
+            self._offset += len(line)
+            return True
+
+    def is_admitted(self, user_id, event_id):
+        if not os.path.exists(self.path):
+            return False
+        with self._lock, open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            self._catch_up(f)
+        return (event_id, user_id) in self._admitted
+
+    def synced_offset(self):
+        try:
+            with open(self.synced_path) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def mark_synced(self, offset):
+        tmp = f"{self.synced_path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp, self.synced_path)
+
+    def pending(self):
+        """Return [(end offset, row)] for check-ins not yet written to the database."""
+        if not os.path.exists(self.path):
+            return []
+        rows = []
+        with open(self.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            offset = self.synced_offset()
+            f.seek(offset)
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                rows.append((offset, json.loads(line)))
+        return rows
+
+
+class Breaker:
+    """Keeps the door on the replica for a while after the database fails,
+    instead of paying the connect timeout again on every scan."""
+
+    def __init__(self, cooldown=CHECK_IN_BREAKER_SECONDS):
+        self.cooldown = cooldown
+        self._open_until = 0
+
+    def trip(self):
+        if not self.is_open():
+            logger.warning("database unreachable, door scans use the replica for %ss", self.cooldown)
+        self._open_until = time.monotonic() + self.cooldown
+
+    def is_open(self):
+        return time.monotonic() < self._open_until
+
+
+snapshot = Snapshot()
+journal = Journal()
+breaker = Breaker()
+
+
+def offline():
+    """Whether door scans should skip the database and go straight to the replica."""
+    return CHECK_IN_MODE == "offline" or (CHECK_IN_MODE == "auto" and breaker.is_open())
+
+
+def check_in(user_id, ticket_type, event_id):
+    """Admit a guest to an event against the replica; return (status, holder).
+
+    Like the online path, a signed token for a user the replica knows is enough.
+    """
+    holder = snapshot.lookup(user_id)
+    if holder is None:
+        return "invalid", None
+    snapshot_event_id = snapshot.info()["event_id"]
+    if (holder.on_event and snapshot_event_id == event_id) or not journal.admit({
+        "user_id": holder.user_id,
+        "phone": holder.phone,
+        "ticket_type": ticket_type,
+        "promoter": holder.promoter,
+        "event_id": event_id,
+        "timestamp": datetime.utcnow().isoformat(),
+    }):
+        return "used", holder
+    return "ok", holder
+
+
+def sync(path=REPLICA_PATH, wait=True):
+    """Rewrite the snapshot from the database; return the holder count, or None
+    when wait is off and another worker is already syncing."""
+    with open(f"{path}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        event_id = events.current_id()
+        session = Session()
+        try:
+            holders = [
+                Holder(*row) for row in session.query(
+                    User.user_id, User.has_ticket, User.on_event, User.is_admin,
+                    User.ticket_type, User.phone, User.telegram_tag, User.promoter
+                ).filter(User.user_id.isnot(None))
+            ]
+        finally:
+            Session.remove()
+        return write_snapshot(path, holders, event_id)
+
+
+def reconcile(batch_size=500):
+    """Replay journalled check-ins into the database; return (admitted, already in)."""
+    with open(f"{journal.synced_path}.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is already reconciling
+            return 0, 0
+        admitted = conflicts = 0
+        pending = journal.pending()
+        current_event_id = events.current_id()
+        session = Session()
+        try:
+            for start in range(0, len(pending), batch_size):
+                chunk = pending[start:start + batch_size]
+                for _, row in chunk:
+                    event_id = row.get("event_id", 0)
+                    if event_id == current_event_id:
+                        # The same conditional UPDATE as the online path, so replaying a
+                        # chunk twice never admits anyone twice
+                        promoter = session.execute(
+                            update(User).where(User.user_id == row["user_id"], User.on_event.isnot(True))
+                            .values(on_event=True).returning(User.promoter)
+                        ).first()
+                    elif session.query(Attendance.id).filter_by(user_id=row["user_id"], event_id=event_id).first():
+                        promoter = None
+                    else:
+                        # The event has been closed since: record the visit, leave on_event alone
+                        promoter = session.query(User.promoter).filter_by(user_id=row["user_id"]).first()
+                    if promoter is None:
+                        conflicts += 1
+                        logger.warning("offline check-in of %s was already recorded", row["user_id"])
+                        continue
+                    session.execute(insert(Attendance).values(
+                        user_id=row["user_id"], phone=row["phone"], ticket_type=row["ticket_type"],
+                        event_id=event_id, timestamp=datetime.fromisoformat(row["timestamp"]),
+                    ))
+                    stats.increment(session, "attendance", event_id=event_id)
+                    if promoter.promoter:
+                        stats.record_check_in(session, promoter.promoter, row["ticket_type"], event_id=event_id)
+                    admitted += 1
+                session.commit()
+                journal.mark_synced(chunk[-1][0])
+        finally:
+            Session.remove()
+        return admitted, conflicts
+
+
+def run_reconciler():
+    last_sync = 0
+    while True:
+        try:
+            admitted, conflicts = reconcile()
+            if admitted or conflicts:
+                logger.info("replica reconcile: %d admitted, %d already in", admitted, conflicts)
+            if time.monotonic() - last_sync >= REPLICA_SYNC_INTERVAL:
+                # Skipped while another worker syncs: its snapshot serves this one too
+                sync(wait=False)
+                last_sync = time.monotonic()
+        except Exception:
+            logger.warning("replica reconcile failed, retrying in %ss", REPLICA_RECONCILE_INTERVAL, exc_info=True)
+        time.sleep(REPLICA_RECONCILE_INTERVAL)
+
+
+def start_reconciler():
+    if CHECK_IN_MODE == "online":
+        return None
+    thread = threading.Thread(target=run_reconciler, name="replica-reconcile", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "sync"
+    if command == "sync":
+        print(f"{sync()} ticket holders written to {REPLICA_PATH}")
+    elif command == "reconcile":
+        print("%d admitted, %d already in" % reconcile())
+    elif command == "status":
+        print(json.dumps({"snapshot": snapshot.info(), "pending": len(journal.pending())}))
+    else:
+        sys.exit(f"usage: {sys.argv[0]} sync|reconcile|status")
@@ -0,0 +1,215 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from sqlalchemy import update, func, or_, text
+from sqlalchemy.exc import IntegrityError
+from models import Session, Stat, PromoterStat, User, Registration, Attendance, Event, engine
+
+logger = logging.getLogger(__name__)
+
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "300"))
+# Where workers without Postgres advisory locks (SQLite) agree on a single reconciler
+STATS_LOCK_PATH = os.getenv("STATS_LOCK_PATH", "data/stats.lock")
+# Postgres advisory lock key held by the one reconciler running at a time
+RECONCILE_LOCK_KEY = 0x756C7374
+
+# Counter name -> (model whose rows it counts, whether it is kept per event)
+COUNTED = {
+    "users": (User, False),
+    "registrations": (Registration, True),
+    "attendance": (Attendance, True),
+}
+
+
+def _bump(session, model, key, **amounts):
+    """Add amounts to the row identified by key, creating it if needed."""
+    condition = [getattr(model, column) == value for column, value in key.items()]
+    values = {column: getattr(model, column) + amount for column, amount in amounts.items()}
+    if session.execute(update(model).where(*condition).values(**values)).rowcount:
+        return
+    try:
+        with session.begin_nested():
+            session.add(model(**key, **amounts))
+    except IntegrityError:
+        # Another transaction created the row first
+        session.execute(update(model).where(*condition).values(**values))
+
+
+def increment(session, name, amount=1, event_id=0):
+    """Bump a counter inside the caller's transaction, so it commits with the insert."""
+    _bump(session, Stat, {"name": name, "event_id": event_id}, value=amount)
+
+
+def record_invite(session, promoter):
+    _bump(session, PromoterStat, {"event_id": 0, "promoter": promoter, "ticket_type": ""}, invited=1)
+
+
+def record_check_in(session, promoter, ticket_type, count=1, event_id=0):
+    key = {"event_id": event_id, "promoter": promoter}
+    _bump(session, PromoterStat, dict(key, ticket_type=""), attended=count)
+    _bump(session, PromoterStat, dict(key, ticket_type=ticket_type or ""), attended=count)
+
+
+def get(name, event_id=0):
+    session = Session()
+    stat = session.get(Stat, (name, event_id))
+    return stat.value if stat else 0
+
+
+def get_promoter(promoter, event_id=0):
+    """Return (invited overall, attended at the event)."""
+    session = Session()
+    invited = session.get(PromoterStat, (0, promoter, ""))
+    attended = invited if event_id == 0 else session.get(PromoterStat, (event_id, promoter, ""))
+    return (invited.invited if invited else 0, attended.attended if attended else 0)
+
+
+def leaderboard(limit=10, event_id=0):
+    """Return [(promoter, invited, attended, {ticket_type: attended})] best first."""
+    session = Session()
+    top = session.query(PromoterStat).filter_by(event_id=event_id, ticket_type="").order_by(
+        PromoterStat.attended.desc(), PromoterStat.invited.desc()
+    ).limit(limit).all()
+    by_type = {stat.promoter: {} for stat in top}
+    invited = {stat.promoter: stat.invited for stat in top}
+    for stat in session.query(PromoterStat).filter(
+        PromoterStat.promoter.in_(list(by_type)),
+        or_(PromoterStat.event_id == event_id, PromoterStat.event_id == 0),
+    ):
+        if stat.event_id == event_id and stat.ticket_type:
+            by_type[stat.promoter][stat.ticket_type] = stat.attended
+        elif stat.event_id == 0 and not stat.ticket_type:
+            invited[stat.promoter] = stat.invited
+    return [(stat.promoter, invited[stat.promoter], stat.attended, by_type[stat.promoter]) for stat in top]
+
+
+def _counter_drift(session, event_id):
+    """Return {name: counted - stored} for the counters that are off."""
+    drift = {}
+    for name, (model, per_event) in COUNTED.items():
+        if not per_event and event_id:
+            continue
+        query = session.query(func.count()).select_from(model)
+        if per_event:
+            query = query.filter(model.event_id == event_id)
+        counted = query.scalar()
+        stored = session.query(Stat.value).filter_by(name=name, event_id=event_id).scalar() or 0
+        if counted != stored:
+            logger.warning("stats %s (event %s) drifted: %d counted, %d stored", name, event_id, counted, stored)
+            drift[name] = counted - stored
+    return drift
+
+
+def _promoter_drift(session, event_id):
+    """Return {(promoter, ticket_type): (invited drift, attended drift)} for the rollups that are off."""
+    stored = {
+        (promoter, ticket_type): (invited, attended)
+        for promoter, ticket_type, invited, attended in session.query(
+            PromoterStat.promoter, PromoterStat.ticket_type, PromoterStat.invited, PromoterStat.attended
+        ).filter_by(event_id=event_id)
+    }
+    actual = {}
+    if event_id == 0:
+        for promoter, invited in session.query(User.promoter, func.count()).filter(
+            User.promoter.isnot(None)
+        ).group_by(User.promoter):
+            actual[(promoter, "")] = [invited, 0]
+    for promoter, ticket_type, attended in session.query(
+        User.promoter, Attendance.ticket_type, func.count()
+    ).join(Attendance, User.user_id == Attendance.user_id).filter(
+        User.promoter.isnot(None), Attendance.event_id == event_id
+    ).group_by(User.promoter, Attendance.ticket_type):
+        actual.setdefault((promoter, ""), [0, 0])[1] += attended
+        actual.setdefault((promoter, ticket_type or ""), [0, 0])[1] += attended
+
+    drift = {}
+    for key in stored.keys() | actual.keys():
+        invited, attended = actual.get(key, (0, 0))
+        stored_invited, stored_attended = stored.get(key, (0, 0))
+        if (invited, attended) != (stored_invited, stored_attended):
+            drift[key] = (invited - stored_invited, attended - stored_attended)
+    return drift
+
+
+@contextmanager
+def _reconcile_lock(wait=True):
+    """Yield whether this process got to reconcile: only one does at a time, across workers."""
+    if engine.dialect.name == "postgresql":
+        # A transaction-level lock on its own connection, so it also holds behind PgBouncer
+        with engine.connect() as conn, conn.begin():
+            if wait:
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": RECONCILE_LOCK_KEY})
+                yield True
+            else:
+                yield conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": RECONCILE_LOCK_KEY}).scalar()
+        return
+    os.makedirs(os.path.dirname(STATS_LOCK_PATH) or ".", exist_ok=True)
+    with open(STATS_LOCK_PATH, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def reconcile(event_ids=None, wait=True):
+    """Correct counters and promoter rollups by their drift from the real row counts.
+
+    Counts and stored values are read without row locks from one snapshot, and only
+    the difference is written back, so increments committed meanwhile are kept.
+    By default only event 0 and open events are touched: closed events are frozen.
+    Returns False when wait is off and another worker is already reconciling.
+    """
+    with _reconcile_lock(wait) as acquired:
+        if not acquired:
+            return False
+        session = Session()
+        try:
+            if event_ids is None:
+                event_ids = [0] + [event.id for event in session.query(Event.id).filter_by(status="open")]
+                session.commit()
+            for event_id in event_ids:
+                if engine.dialect.name == "postgresql":
+                    # Every count and stored value below comes from the same snapshot. SQLite
+                    # (development only) has none: a write landing mid-count shows up as drift
+                    # that the next run takes back
+                    session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+                counters = _counter_drift(session, event_id)
+                promoters = _promoter_drift(session, event_id)
+                session.commit()
+
+                for name, drift in counters.items():
+                    increment(session, name, drift, event_id)
+                for (promoter, ticket_type), (invited, attended) in promoters.items():
+                    _bump(session, PromoterStat, {"event_id": event_id, "promoter": promoter, "ticket_type": ticket_type},
+                          invited=invited, attended=attended)
+                session.commit()
+        finally:
+            Session.remove()
+    return True
+
+
+def run_reconciler():
+    while True:
+        try:
+            # Every worker runs this loop, but only the one holding the lock counts
+            reconcile(wait=False)
+        except Exception:
+            logger.exception("stats reconcile failed")
+        time.sleep(STATS_RECONCILE_INTERVAL)
+
+
+def start_reconciler():
+    thread = threading.Thread(target=run_reconciler, name="stats-reconcile", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    reconcile()
+    for name in COUNTED:
+        print(f"{name}: {get(name)}")
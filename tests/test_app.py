@@ -0,0 +1,109 @@
+"""Routing updates to FLOOD_LIMITS kinds, the webhook and role changes.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR.name, 'app.db')}")
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:APPtestAPPtestAPPtestAPPtestAPPtest")
+
+
+def message(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": 5000, "type": "private"},
+            "from": {"id": 5000, "is_bot": False, "first_name": "Guest"},
+        },
+    }
+
+
+class UpdateKindTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Imported here so the other test modules set their environment first
+        global app
+        import app
+
+    def kind(self, text):
+        return app.update_kind(app.Update.de_json(message(1, text), app.bot))
+
+    def test_commands(self):
+        self.assertEqual(self.kind("/start"), "start")
+        self.assertEqual(self.kind("/start@some_bot payload"), "start")
+        self.assertEqual(self.kind(app.COUNT_BUTTONS[0]), "count")
+
+    def test_bare_slash_is_not_a_command(self):
+        for text in ("/", "/ ", "/  @bot"):
+            self.assertEqual(self.kind(text), "default", text)
+
+    def test_webhook_accepts_a_bare_slash(self):
+        client = app.app.test_client()
+        with mock.patch.object(app, "start_handler_threads"):
+            response = client.post("/webhook", json=message(5001, "/"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(app.update_queue.get_nowait().update_id, 5001)
+
+    def test_health_reports_each_pool(self):
+        health = app.app.test_client().get("/health").get_json()
+        self.assertIn("checkouts", health["db_pool"])
+        self.assertIn("checkouts", health["door_db_pool"])
+        self.assertIsNot(app.pool_stats, app.door_pool_stats)
+
+
+class ChangeRolesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        global app
+        import app
+        from models import User, init_db
+        init_db()
+        session = app.Session()
+        session.add(User(user_id="5100", telegram_tag="boss", is_admin=True))
+        session.add_all(User(user_id=str(5101 + i), telegram_tag=f"staff{i}") for i in range(5))
+        session.commit()
+        app.Session.remove()
+
+    @classmethod
+    def tearDownClass(cls):
+        # The database may be shared with the other test modules, which count every user
+        session = app.Session()
+        session.query(app.User).filter(app.User.user_id.in_([str(5100 + i) for i in range(6)])).delete()
+        session.commit()
+        app.Session.remove()
+
+    def test_promotes_without_reloading_each_user(self):
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+        event.listen(app.engine, "before_cursor_execute", listener)
+        self.addCleanup(event.remove, app.engine, "before_cursor_execute", listener)
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=5100), message=mock.Mock())
+        context = SimpleNamespace(bot=SimpleNamespace(username="bot"))
+
+        with mock.patch.object(app.broadcast, "Broadcaster") as broadcaster:
+            broadcaster.return_value.send_many.return_value = ["sent"] * 5
+            app.change_roles(update, context, "promote", [f"staff{i}" for i in range(5)] + ["nobody"])
+        app.Session.remove()
+
+        selects = [statement for statement in statements if statement.lstrip().upper().startswith("SELECT")]
+        # is_admin and the one lookup for every tag
+        self.assertEqual(len(selects), 2, selects)
+        notified = broadcaster.return_value.send_many.call_args.args[0]
+        self.assertEqual(sorted(user_id for user_id, text in notified), list(range(5101, 5106)))
+        reply = update.message.reply_text.call_args.args[0]
+        self.assertIn("Теперь администраторы: 5", reply)
+        self.assertIn("Не найдены: 1 — @nobody", reply)
+
+
+if __name__ == "__main__":
+    unittest.main()
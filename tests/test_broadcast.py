@@ -0,0 +1,112 @@
+"""Broadcasts against fake_bot_api.py and a throwaway SQLite database.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.TemporaryDirectory()
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(WORKDIR.name, 'broadcast.db')}",
+    "TELEGRAM_TOKEN": "123456:BROADCASTtestBROADCASTtestBROADCAST",
+    "BROADCAST_RATE": "50",
+    "BROADCAST_CONCURRENCY": "4",
+    "BROADCAST_CHUNK": "10",
+    "BROADCAST_HEARTBEAT": "0.2",
+})
+
+import broadcast  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from models import Session, User, BroadcastJob, init_db  # noqa: E402
+
+USERS = 40
+BLOCKED = {1005, 1017, 1033}
+
+
+class BroadcastTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_db()
+        session = Session()
+        session.add_all(User(user_id=str(1000 + i), telegram_tag=f"user{i}") for i in range(USERS))
+        session.commit()
+        Session.remove()
+
+    def setUp(self):
+        self.api = FakeBotAPI(("127.0.0.1", 0), blocked=BLOCKED).start()
+        self.bot = broadcast.Bot(token=broadcast.TOKEN, base_url=f"{self.api.url}/bot",
+                                 base_file_url=f"{self.api.url}/file/bot")
+
+    def tearDown(self):
+        self.api.shutdown()
+        self.api.server_close()
+
+    def recipients(self):
+        return [int(params["chat_id"]) for method, params in self.api.messages if method == "sendMessage"]
+
+    def test_sends_once_to_everyone_and_counts_blocked(self):
+        # Half the configured rate: the broadcaster has to back off on 429s
+        self.api.rate_limit = 25
+        job = broadcast.run_job(broadcast.create_job("hello"), self.bot)
+
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.blocked, len(BLOCKED))
+        self.assertEqual(job.sent, USERS - len(BLOCKED))
+        self.assertEqual(job.failed, 0)
+        recipients = self.recipients()
+        self.assertEqual(sorted(recipients), sorted(set(range(1000, 1000 + USERS)) - BLOCKED))
+
+    def test_retry_after_halves_the_rate(self):
+        self.api.rate_limit = 5
+        broadcaster = broadcast.Broadcaster(self.bot, rate=20, concurrency=4)
+        results = broadcaster.send_many([(2000 + i, "hi") for i in range(12)])
+
+        self.assertEqual(results.count("sent"), 12)
+        self.assertLess(broadcaster.bucket.rate, 20)
+
+    def test_resumes_a_crashed_job_from_its_checkpoint(self):
+        job_id = broadcast.create_job("again")
+        session = Session()
+        checkpoint = session.query(User.id).filter(User.user_id == "1019").scalar()
+        session.query(BroadcastJob).filter_by(id=job_id).update({
+            "status": "running", "owner": "crashed", "checkpoint": checkpoint, "sent": 20,
+            "heartbeat_at": datetime.utcnow() - timedelta(seconds=broadcast.BROADCAST_STALE_AFTER + 1),
+        })
+        session.commit()
+        Session.remove()
+
+        broadcast.resume_jobs(self.bot)
+
+        job = broadcast.get_job(job_id)
+        self.assertEqual(job.status, "done")
+        self.assertEqual(sorted(self.recipients()), [i for i in range(1020, 1000 + USERS) if i not in BLOCKED])
+        self.assertEqual(job.sent, 20 + 20 - len([i for i in BLOCKED if i >= 1020]))
+
+    def test_running_job_is_not_reclaimed(self):
+        job_id = broadcast.create_job("mine")
+        self.assertIsNotNone(broadcast.claim(job_id))
+        self.assertIsNone(broadcast.claim(job_id))
+        self.assertIsNone(broadcast.run_job(job_id, self.bot))
+
+    def test_stops_once_taken_over(self):
+        job_id = broadcast.create_job("taken")
+        owner = broadcast.claim(job_id)
+        # Another worker reclaimed the job while this one was still sending
+        session = Session()
+        session.query(BroadcastJob).filter_by(id=job_id).update({"owner": "other"})
+        session.commit()
+        Session.remove()
+
+        self.assertIsNone(broadcast.Broadcaster(self.bot).run(job_id, owner))
+        self.assertLessEqual(len(self.recipients()), broadcast.BROADCAST_CHUNK)
+        job = broadcast.get_job(job_id)
+        self.assertEqual((job.owner, job.sent, job.checkpoint), ("other", 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
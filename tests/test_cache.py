@@ -0,0 +1,50 @@
+"""TTLCache expiry, LRU order and the byte bound.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache  # noqa: E402
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        ttl_cache = cache.TTLCache(maxsize=2)
+        ttl_cache.set("a", 1)
+        ttl_cache.set("b", 2)
+        ttl_cache.get("a")
+        ttl_cache.set("c", 3)
+        self.assertEqual((ttl_cache.get("a"), ttl_cache.get("b"), ttl_cache.get("c")), (1, None, 3))
+
+    def test_entries_expire(self):
+        ttl_cache = cache.TTLCache(ttl=10)
+        with mock.patch.object(cache.time, "monotonic", return_value=100):
+            ttl_cache.set("a", 1)
+            self.assertTrue(ttl_cache.add("b"))
+            self.assertFalse(ttl_cache.add("b"))
+        with mock.patch.object(cache.time, "monotonic", return_value=110):
+            self.assertIsNone(ttl_cache.get("a"))
+            self.assertTrue(ttl_cache.add("b"))
+
+    def test_total_size_stays_under_maxbytes(self):
+        ttl_cache = cache.TTLCache(maxsize=100, maxbytes=250, sizeof=len)
+        for key in "abc":
+            ttl_cache.set(key, b"x" * 100)
+        self.assertEqual((len(ttl_cache), ttl_cache.bytes), (2, 200))
+        self.assertIsNone(ttl_cache.get("a"))
+
+        ttl_cache.set("b", b"x" * 10)
+        ttl_cache.invalidate("c")
+        self.assertEqual(ttl_cache.stats()["bytes"], 10)
+        # Larger than the whole budget: not kept at all
+        ttl_cache.set("d", b"x" * 300)
+        self.assertEqual((len(ttl_cache), ttl_cache.bytes), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Opening and closing events.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR.name, 'events.db')}")
+os.environ.setdefault("STATS_LOCK_PATH", os.path.join(WORKDIR.name, "stats.lock"))
+
+from sqlalchemy.exc import IntegrityError  # noqa: E402
+import events  # noqa: E402
+from models import Session, Event, init_db  # noqa: E402
+
+
+class EventsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_db()
+
+    def tearDown(self):
+        events.close_event()
+
+    def test_only_one_event_is_open(self):
+        opened = events.open_event("first")
+        self.assertEqual(opened.status, "open")
+        self.assertIsNone(events.open_event("second"))
+        self.assertEqual(events.current_id(), opened.id)
+
+        self.assertEqual(events.close_event().id, opened.id)
+        self.assertIsNotNone(events.open_event("third"))
+
+    def test_database_rejects_a_second_open_event(self):
+        # What a concurrent open_event() that passed the check would insert
+        events.open_event("first")
+        session = Session()
+        session.add(Event(name="racing", status="open"))
+        with self.assertRaises(IntegrityError):
+            session.commit()
+        session.rollback()
+        Session.remove()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+"""The offline check-in replica: snapshot lookups, the breaker and journal replay.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import fcntl
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR.name, 'replica.db')}")
+
+import replica  # noqa: E402
+import stats  # noqa: E402
+from models import Session, User, Attendance, init_db  # noqa: E402
+
+
+def holder(user_id, **fields):
+    values = dict(has_ticket=False, on_event=False, is_admin=False, ticket_type=None,
+                  phone=f"+7900{user_id}", telegram_tag=f"user{user_id}", promoter=None)
+    values.update(fields)
+    return replica.Holder(str(user_id), **values)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "tickets.replica")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_finds_every_holder_and_nothing_else(self):
+        # Sequential ids and a large id, so probes run into occupied slots
+        holders = [holder(i, is_admin=i % 7 == 0, promoter="promo" if i % 2 else None) for i in range(1, 1000)]
+        holders.append(holder(2 ** 63 - 1, telegram_tag="x" * 40))
+        replica.write_snapshot(self.path, holders, event_id=12)
+        snapshot = replica.Snapshot(self.path)
+
+        for expected in holders[:-1]:
+            self.assertEqual(snapshot.lookup(expected.user_id), expected)
+        # Text fields are truncated to their slot width
+        self.assertEqual(snapshot.lookup(2 ** 63 - 1).telegram_tag, "x" * 32)
+        for missing in (0, 1000, 123456789, "abc", None):
+            self.assertIsNone(snapshot.lookup(missing))
+        info = snapshot.info()
+        self.assertEqual((info["holders"], info["event_id"]), (1000, 12))
+        self.assertGreaterEqual(info["slots"], 2000)
+
+    def test_rewrites_replace_the_file_and_are_picked_up(self):
+        replica.write_snapshot(self.path, [holder(1)])
+        snapshot = replica.Snapshot(self.path)
+        self.assertIsNotNone(snapshot.lookup(1))
+        inode = os.stat(self.path).st_ino
+
+        replica.write_snapshot(self.path, [holder(2)])
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        self.assertIsNone(snapshot.lookup(1))
+        self.assertIsNotNone(snapshot.lookup(2))
+        self.assertEqual(os.listdir(self.dir.name), ["tickets.replica"])
+
+    def test_missing_snapshot_knows_nobody(self):
+        snapshot = replica.Snapshot(self.path)
+        self.assertIsNone(snapshot.lookup(1))
+        self.assertIsNone(snapshot.info())
+
+
+class BreakerTest(unittest.TestCase):
+    def test_stays_open_for_the_cooldown(self):
+        breaker = replica.Breaker(cooldown=60)
+        self.assertFalse(breaker.is_open())
+        with mock.patch.object(replica.time, "monotonic", return_value=1000):
+            breaker.trip()
+        with mock.patch.object(replica.time, "monotonic", return_value=1059):
+            self.assertTrue(breaker.is_open())
+        with mock.patch.object(replica.time, "monotonic", return_value=1060):
+            self.assertFalse(breaker.is_open())
+
+    def test_offline_follows_mode_and_breaker(self):
+        breaker = replica.Breaker(cooldown=60)
+        with mock.patch.object(replica, "breaker", breaker):
+            for mode, expected in (("online", False), ("auto", False), ("offline", True)):
+                with mock.patch.object(replica, "CHECK_IN_MODE", mode):
+                    self.assertEqual(replica.offline(), expected)
+            breaker.trip()
+            for mode, expected in (("online", False), ("auto", True), ("offline", True)):
+                with mock.patch.object(replica, "CHECK_IN_MODE", mode):
+                    self.assertEqual(replica.offline(), expected)
+
+
+class JournalTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_db()
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = replica.Journal(os.path.join(self.dir.name, "checkins.jsonl"))
+        self.snapshot_path = os.path.join(self.dir.name, "tickets.replica")
+        patches = [
+            mock.patch.object(replica, "journal", self.journal),
+            mock.patch.object(replica, "snapshot", replica.Snapshot(self.snapshot_path)),
+            mock.patch.object(replica.events, "current_id", return_value=0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def row(self, user_id, event_id=0):
+        return {"user_id": str(user_id), "phone": None, "ticket_type": "vip", "promoter": None,
+                "event_id": event_id, "timestamp": "2026-10-17T22:00:00"}
+
+    def test_admits_once_per_event_across_workers(self):
+        other_worker = replica.Journal(self.journal.path)
+        self.assertTrue(self.journal.admit(self.row(1)))
+        self.assertFalse(other_worker.admit(self.row(1)))
+        self.assertTrue(other_worker.admit(self.row(1, event_id=2)))
+        self.assertTrue(self.journal.is_admitted("1", 2))
+        self.assertFalse(self.journal.is_admitted("2", 0))
+
+    def test_check_in_admits_known_users_once(self):
+        replica.write_snapshot(self.snapshot_path, [holder(10), holder(11, on_event=True)], event_id=0)
+        self.assertEqual(replica.check_in("10", "vip", 0)[0], "ok")
+        self.assertEqual(replica.check_in("10", "vip", 0)[0], "used")
+        # Already checked in online before the snapshot was taken
+        self.assertEqual(replica.check_in("11", "vip", 0)[0], "used")
+        self.assertEqual(replica.check_in("12", "vip", 0), ("invalid", None))
+
+    def test_reconcile_replays_each_check_in_once(self):
+        session = Session()
+        session.add_all([
+            User(user_id="7000", promoter="promo"),
+            User(user_id="7001", on_event=True),
+            User(user_id="7002", promoter="promo"),
+        ])
+        session.commit()
+        Session.remove()
+        attended = stats.get("attendance")
+
+        self.journal.admit(self.row(7000))
+        # Checked in online as well, before the database went away
+        self.journal.admit(self.row(7001))
+        # Journalled for an event that has been closed since
+        self.journal.admit(self.row(7002, event_id=9))
+
+        self.assertEqual(replica.reconcile(), (2, 1))
+        self.assertEqual(replica.reconcile(), (0, 0))
+
+        session = Session()
+        self.assertTrue(session.query(User.on_event).filter_by(user_id="7000").scalar())
+        self.assertFalse(session.query(User.on_event).filter_by(user_id="7002").scalar())
+        visits = {(row.user_id, row.event_id) for row in session.query(Attendance).filter(
+            Attendance.user_id.in_(["7000", "7001", "7002"]))}
+        Session.remove()
+        self.assertEqual(visits, {("7000", 0), ("7002", 9)})
+        self.assertEqual(stats.get("attendance"), attended + 1)
+        self.assertEqual(stats.get("attendance", 9), 1)
+
+    def test_sync_is_skipped_while_another_worker_syncs(self):
+        with open(f"{self.snapshot_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertIsNone(replica.sync(self.snapshot_path, wait=False))
+        self.assertGreaterEqual(replica.sync(self.snapshot_path, wait=False), 0)
+        self.assertIsNotNone(replica.Snapshot(self.snapshot_path).info())
+
+
+if __name__ == "__main__":
+    unittest.main()
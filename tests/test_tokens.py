@@ -0,0 +1,92 @@
+"""Signed ticket tokens: round trips, forgeries and key rotation.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import hmac
+import hashlib
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tokens  # noqa: E402
+
+
+def keyring(spec):
+    return {key_id: hmac.new(key, digestmod=hashlib.sha256) for key_id, key in tokens.parse_keys(spec).items()}
+
+
+class TokensTest(unittest.TestCase):
+    def use_keys(self, spec, active):
+        for patch in (mock.patch.object(tokens, "_hmacs", keyring(spec)),
+                      mock.patch.object(tokens, "ACTIVE_KEY_ID", active)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def setUp(self):
+        self.use_keys("1:first-secret", 1)
+
+    def test_round_trip(self):
+        for ticket_type in tokens.TICKET_TYPES:
+            payload = tokens.sign(123456789, ticket_type, event_id=7)
+            self.assertEqual(len(payload), tokens.TOKEN_LENGTH)
+            self.assertEqual(tokens.verify(payload), tokens.Ticket("123456789", ticket_type, 7, 1))
+        # The largest Telegram ids still fit
+        self.assertEqual(tokens.verify(tokens.sign(2 ** 63 - 1, "vip")).user_id, str(2 ** 63 - 1))
+
+    def test_tampered_body_or_mac_is_rejected(self):
+        payload = tokens.sign(42, "free", event_id=3)
+        body_length = 2 * tokens.BODY.size
+        for position in (5, body_length - 1, body_length, len(payload) - 1):
+            flipped = "0" if payload[position] != "0" else "1"
+            forged = payload[:position] + flipped + payload[position + 1:]
+            self.assertIsNone(tokens.verify(forged), position)
+        # Another user's body under this token's MAC
+        other = tokens.sign(43, "free", event_id=3)
+        self.assertIsNone(tokens.verify(other[:body_length] + payload[body_length:]))
+
+    def test_unknown_key_id_is_rejected(self):
+        payload = tokens.sign(42, "vip")
+        self.use_keys("2:second-secret", 2)
+        self.assertIsNone(tokens.verify(payload))
+
+    def test_rotation_across_keys(self):
+        old = tokens.sign(42, "vip")
+        self.use_keys("1:first-secret,2:second-secret", 2)
+        new = tokens.sign(42, "vip")
+        self.assertNotEqual(old, new)
+        self.assertEqual(tokens.verify(old).key_id, 1)
+        self.assertEqual(tokens.verify(new).key_id, 2)
+
+        # Once the old key is dropped only its tickets stop verifying
+        self.use_keys("2:second-secret", 2)
+        self.assertIsNone(tokens.verify(old))
+        self.assertEqual(tokens.verify(new).key_id, 2)
+        # Same key id, different secret
+        self.use_keys("2:leaked-and-replaced", 2)
+        self.assertIsNone(tokens.verify(new))
+
+    def test_wrong_event_is_rejected(self):
+        payload = tokens.sign(42, "backstage", event_id=7)
+        self.assertEqual(tokens.verify(payload, event_id=7).event_id, 7)
+        self.assertIsNone(tokens.verify(payload, event_id=8))
+        self.assertIsNone(tokens.verify(payload, event_id=0))
+
+    def test_malformed_payloads_are_rejected(self):
+        payload = tokens.sign(42, "vip")
+        for malformed in ("", payload[:-2], payload + "00", "Z" * tokens.TOKEN_LENGTH,
+                          payload[:-1] + "G", "https://t.me/some_bot?start=abc"):
+            self.assertIsNone(tokens.verify(malformed), malformed)
+
+    def test_parse_keys(self):
+        self.assertEqual(tokens.parse_keys(" 1:a, 255:b,"), {1: b"a", 255: b"b"})
+        self.assertEqual(tokens.parse_keys(""), {})
+        for spec in ("256:too-big", "-1:negative", "x:not-a-number", "3:"):
+            with self.assertRaises(ValueError, msg=spec):
+                tokens.parse_keys(spec)
+
+
+if __name__ == "__main__":
+    unittest.main()
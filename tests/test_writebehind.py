@@ -0,0 +1,86 @@
+"""Write-behind batches: group commit, poison rows and an unreachable database.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.TemporaryDirectory()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(WORKDIR.name, 'writebehind.db')}")
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+import writebehind  # noqa: E402
+from models import Session, Registration, init_db  # noqa: E402
+
+
+def reject(session, rows):
+    if any(row["user_id"] == "poison" for row in rows):
+        raise ValueError("poison row")
+
+
+class WriteBehindTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_db()
+
+    def buffer(self, **kwargs):
+        buffer = writebehind.WriteBehindBuffer(Registration, "registrations", max_batch=8, max_delay=0.05, **kwargs)
+        self.addCleanup(buffer.close)
+        return buffer
+
+    def add_all(self, buffer, user_ids):
+        """Add rows concurrently, as durable adds from handler threads; return what each add raised."""
+        errors = {}
+
+        def add(user_id):
+            try:
+                buffer.add({"user_id": user_id, "event_id": 0}, durable=True)
+            except RuntimeError as exc:
+                errors[user_id] = exc
+
+        threads = [threading.Thread(target=add, args=(user_id,)) for user_id in user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return errors
+
+    def written(self, user_ids):
+        session = Session()
+        try:
+            return sorted(row.user_id for row in session.query(Registration.user_id).filter(
+                Registration.user_id.in_(user_ids)))
+        finally:
+            Session.remove()
+
+    def test_poison_row_is_dropped_and_the_rest_written(self):
+        buffer = self.buffer(after_flush=reject)
+        user_ids = [f"wb{i}" for i in range(7)] + ["poison"]
+        errors = self.add_all(buffer, user_ids)
+
+        self.assertEqual(list(errors), ["poison"])
+        self.assertEqual(self.written(user_ids), sorted(user_ids[:-1]))
+        self.assertEqual(buffer.stats()["dropped_rows"], 1)
+
+    def test_unreachable_database_gives_up_after_the_deadline(self):
+        buffer = self.buffer()
+        down = OperationalError("INSERT", {}, Exception("connection refused"))
+        with mock.patch.object(writebehind, "WRITE_RETRY_DEADLINE", 0.3), \
+                mock.patch.object(buffer, "_write", side_effect=down) as write:
+            errors = self.add_all(buffer, ["down1", "down2"])
+
+        self.assertEqual(sorted(errors), ["down1", "down2"])
+        # Retried as one batch, never split
+        self.assertTrue(all(len(call.args[0]) == 2 for call in write.call_args_list))
+        self.assertGreater(write.call_count, 1)
+        self.assertEqual(buffer.stats()["dropped_rows"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import os
+import argparse
+import threading
+from functools import partial
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import dotenv
+from qrcode import QRCode
+from PIL import Image, ImageDraw, ImageFont
+from cache import TTLCache
+import tokens
+from tokens import TICKET_TYPES
+
+dotenv.load_dotenv()
+
+TICKET_FORMAT = os.getenv("TICKET_FORMAT", "JPEG")
+# A rendered ticket is ~260KB and every worker keeps its own cache
+TICKET_CACHE_SIZE = int(os.getenv("TICKET_CACHE_SIZE", "500"))
+TICKET_CACHE_BYTES = int(os.getenv("TICKET_CACHE_BYTES", str(64 * 1024 * 1024)))
+TICKET_CACHE_TTL = float(os.getenv("TICKET_CACHE_TTL", str(12 * 3600)))
+
+TEMPLATE_PATH = "img/{}_ticket.png"
+FONT_PATH = "fonts/tag.ttf"
+
+# Layout of the white card on the 1080x1920 templates
+QR_SIZE = 600
+QR_POSITION = (240, 1100)
+TAG_POSITION = (540, 1765)
+TAG_FONT_SIZE = 56
+
+_templates = {}
+_font = None
+_assets_lock = threading.Lock()
+# Entries are (tag, payload, image bytes)
+ticket_cache = TTLCache(maxsize=TICKET_CACHE_SIZE, ttl=TICKET_CACHE_TTL,
+                        maxbytes=TICKET_CACHE_BYTES, sizeof=lambda entry: len(entry[2]))
+
+
+def load_assets():
+    """Decode every template and the tag font once per process."""
+    global _font
+    with _assets_lock:
+        if _font is not None:
+            return
+        for ticket_type in TICKET_TYPES:
+            with Image.open(TEMPLATE_PATH.format(ticket_type)) as template:
+                _templates[ticket_type] = template.convert("RGB")
+        _font = ImageFont.truetype(FONT_PATH, TAG_FONT_SIZE)
+
+
+def render_ticket_bytes(ticket_type, user_id, tag=None, payload=None):
+    load_assets()
+    ticket = _templates[ticket_type].copy()
+
+    qr = QRCode(border=1)
+    qr.add_data(payload or tokens.sign(user_id, ticket_type))
+    qr.make(fit=True)
+    code = qr.make_image(fill_color="black", back_color="white").convert("RGB")
+    ticket.paste(code.resize((QR_SIZE, QR_SIZE), Image.NEAREST), QR_POSITION)
+
+    if tag:
+        ImageDraw.Draw(ticket).text(TAG_POSITION, f"@{tag}", font=_font, fill="black", anchor="mm")
+
+    output = BytesIO()
+    if TICKET_FORMAT == "PNG":
+        ticket.save(output, format="PNG", compress_level=1)
+    else:
+        ticket.save(output, format="JPEG", quality=92)
+    return output.getvalue()
+
+
+def render_ticket(ticket_type, user_id, tag=None, event_id=0):
+    """Return the ticket image as a BytesIO, rendering it only on a cache miss."""
+    key = (ticket_type, str(user_id))
+    # Rotating the signing key or switching events changes the payload and the image
+    payload = tokens.sign(user_id, ticket_type, event_id)
+    cached = ticket_cache.get(key)
+    if cached is None or cached[:2] != (tag, payload):
+        cached = (tag, payload, render_ticket_bytes(ticket_type, user_id, tag, payload))
+        ticket_cache.set(key, cached)
+    output = BytesIO(cached[2])
+    output.name = f"ticket.{TICKET_FORMAT.lower()}"
+    return output
+
+
+def _render_job(job, event_id=0):
+    ticket_type, user_id, tag = job
+    payload = tokens.sign(user_id, ticket_type, event_id)
+    return ticket_type, str(user_id), tag, payload, render_ticket_bytes(ticket_type, user_id, tag, payload)
+
+
+def prerender(jobs, workers=None, event_id=0):
+    """Render (ticket_type, user_id, tag) jobs for an event on a process pool into ticket_cache.
+
+    Yields every rendered ticket so callers can also persist them.
+    """
+    render = partial(_render_job, event_id=event_id)
+    with ProcessPoolExecutor(max_workers=workers, initializer=load_assets) as pool:
+        for ticket_type, user_id, tag, payload, data in pool.map(render, jobs, chunksize=16):
+            ticket_cache.set((ticket_type, user_id), (tag, payload, data))
+            yield ticket_type, user_id, data
+
+
+def registered_users(database_url):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT coalesce(ticket_type, 'free'), user_id, telegram_tag FROM users WHERE phone IS NOT NULL"
+        ))
+        return [tuple(row) for row in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render tickets for every registered user")
+    parser.add_argument("--out", default="data/tickets", help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="render processes (default: CPU count)")
+    parser.add_argument("--event-id", type=int, default=None, help="event to sign for (default: the open one)")
+    args = parser.parse_args()
+
+    if args.event_id is None:
+        import events
+        args.event_id = events.current_id()
+    jobs = registered_users(os.getenv("DATABASE_URL"))
+    extension = TICKET_FORMAT.lower()
+    count = 0
+    for ticket_type, user_id, data in prerender(jobs, workers=args.workers, event_id=args.event_id):
+        directory = os.path.join(args.out, ticket_type)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{user_id}.{extension}"), "wb") as f:
+            f.write(data)
+        count += 1
+    print(f"Rendered {count} tickets to {args.out}")
@@ -0,0 +1,95 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from telegram import Bot
+from telegram.utils.helpers import DEFAULT_NONE
+import metrics
+
+# Methods whose result handlers never use, so they can be answered inline
+INLINE_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendChatAction",
+    "editMessageText",
+    "editMessageReplyMarkup",
+    "answerCallbackQuery",
+    "deleteMessage",
+}
+
+# Read-only methods do not affect what the user sees, so they never need to be
+# ordered after a held call
+READ_METHODS = {"getMe", "getChat", "getChatMember", "getFile"}
+
+_local = threading.local()
+
+
+class Capture:
+    def __init__(self):
+        self.deferred = None
+        self.used = False
+
+    @property
+    def response(self):
+        """Body for the webhook HTTP response, or None if nothing was captured."""
+        if self.deferred is None:
+            return None
+        endpoint, data = self.deferred
+        body = {"method": endpoint}
+        for key, value in data.items():
+            # Bot serialises reply markups to JSON strings for multipart uploads
+            body[key] = json.loads(value) if key == "reply_markup" and isinstance(value, str) else value
+        return body
+
+
+def _inlineable(data):
+    return all(isinstance(value, (str, int, float, bool, list, dict)) for value in data.values())
+
+
+class WebhookBot(Bot):
+    """Bot that can return the first API call of a handler as the webhook response.
+
+    Inside capture(), the first call to an INLINE_METHODS method is held back and
+    reported as True to the handler. If the handler makes another call, the held
+    call is sent first so Telegram still sees them in order.
+    """
+
+    def _post(self, endpoint, data=None, timeout=DEFAULT_NONE, api_kwargs=None):
+        capture = getattr(_local, "capture", None)
+        if capture is not None and endpoint not in READ_METHODS:
+            if not capture.used:
+                capture.used = True
+                payload = dict(data or {})
+                if api_kwargs:
+                    payload.update(api_kwargs)
+                self._insert_defaults(payload, timeout)
+                payload = {key: value for key, value in payload.items() if value is not None}
+                if endpoint in INLINE_METHODS and _inlineable(payload):
+                    capture.deferred = (endpoint, payload)
+                    metrics.bot_api_inline.inc(method=endpoint)
+                    return True
+            elif capture.deferred is not None:
+                deferred_endpoint, deferred_data = capture.deferred
+                capture.deferred = None
+                self._timed_post(deferred_endpoint, deferred_data)
+        return self._timed_post(endpoint, data, timeout, api_kwargs)
+
+    def _timed_post(self, endpoint, data=None, timeout=DEFAULT_NONE, api_kwargs=None):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super()._post(endpoint, data, timeout, api_kwargs)
+            failed = False
+            return result
+        finally:
+            metrics.observe_bot_call(endpoint, time.perf_counter() - started, failed)
+
+
+@contextmanager
+def capture():
+    """Capture the first outgoing call made by the current thread."""
+    _local.capture = Capture()
+    try:
+        yield _local.capture
+    finally:
+        _local.capture = None
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError as PoolTimeout
+from models import Session, Registration, Attendance
+import stats
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "200"))
+WRITE_BATCH_DELAY = float(os.getenv("WRITE_BATCH_DELAY", "0.5"))
+# Durable mode makes add() wait until its batch is committed (group commit)
+WRITE_BEHIND_DURABLE = os.getenv("WRITE_BEHIND_DURABLE", "0") == "1"
+WRITE_SHUTDOWN_TIMEOUT = float(os.getenv("WRITE_SHUTDOWN_TIMEOUT", "10"))
+# How long a batch keeps retrying a failing database before its rows are dropped to the log
+WRITE_RETRY_DEADLINE = float(os.getenv("WRITE_RETRY_DEADLINE", "60"))
+
+
+class _Batch:
+    def __init__(self):
+        self.rows = []
+        self.done = threading.Event()
+        # id() of the rows that were dropped instead of committed
+        self.dropped = set()
+
+
+def _transient(exc):
+    """Whether retrying the same rows can succeed (the database was out of reach)."""
+    if isinstance(exc, (OperationalError, PoolTimeout)):
+        return True
+    return isinstance(exc, DBAPIError) and exc.connection_invalidated
+
+
+class WriteBehindBuffer:
+    """Collects rows for one table and inserts them in batches on a background thread.
+
+    A batch is written when it reaches max_batch rows or max_delay seconds after
+    its first row, whichever comes first, with one multi-row INSERT and one commit.
+    """
+
+    def __init__(self, model, counter, after_flush=None, max_batch=WRITE_BATCH_SIZE,
+                 max_delay=WRITE_BATCH_DELAY, durable=WRITE_BEHIND_DURABLE):
+        self.model = model
+        self.counter = counter
+        self.after_flush = after_flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durable = durable
+        self.columns = set(model.__table__.columns.keys())
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.dropped_rows = 0
+        self._batch = _Batch()
+        self._first_added = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def _start(self):
+        # Started on first use so that the thread is created in the forked worker
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name=f"write-behind-{self.model.__tablename__}", daemon=True
+            )
+            self._thread.start()
+
+    def add(self, row, durable=None):
+        """Queue a row (a dict of column values plus any extra keys for after_flush).
+
+        In durable mode this waits for the batch and raises RuntimeError if the
+        row was dropped instead of committed.
+        """
+        row.setdefault("timestamp", datetime.utcnow())
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("write-behind buffer is closed")
+            self._start()
+            batch = self._batch
+            batch.rows.append(row)
+            if self._first_added is None:
+                self._first_added = time.monotonic()
+                self._condition.notify()
+            elif len(batch.rows) >= self.max_batch:
+                self._condition.notify()
+        if self.durable if durable is None else durable:
+            batch.done.wait()
+            if id(row) in batch.dropped:
+                raise RuntimeError(f"write-behind {self.model.__tablename__} row was not written")
+
+    def _take(self):
+        with self._condition:
+            while not self._closed:
+                if self._first_added is not None:
+                    remaining = self._first_added + self.max_delay - time.monotonic()
+                    if len(self._batch.rows) >= self.max_batch or remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+            batch, self._batch = self._batch, _Batch()
+            self._first_added = None
+            return batch
+
+    def _write(self, rows):
+        session = Session()
+        try:
+            session.execute(insert(self.model), [
+                {key: value for key, value in row.items() if key in self.columns} for row in rows
+            ])
+            for event_id, count in Counter(row.get("event_id", 0) for row in rows).items():
+                stats.increment(session, self.counter, count, event_id)
+            if self.after_flush:
+                self.after_flush(session, rows)
+            session.commit()
+        finally:
+            Session.remove()
+
+    def _flush(self, batch):
+        try:
+            self._flush_rows(batch, batch.rows)
+        finally:
+            batch.done.set()
+
+    def _flush_rows(self, batch, rows):
+        """Write rows, retrying while the database is out of reach.
+
+        Rows that fail for any other reason are split in halves until the bad
+        ones are isolated; those, and everything still failing after the retry
+        deadline, are dropped to the log.
+        """
+        delay = 0.1
+        failing_since = None
+        while rows:
+            try:
+                self._write(rows)
+                self.flushed_rows += len(rows)
+                self.flushes += 1
+                return
+            except Exception as exc:
+                logger.exception("write-behind flush of %d %s rows failed", len(rows), self.model.__tablename__)
+                if failing_since is None:
+                    failing_since = time.monotonic()
+                if not _transient(exc):
+                    if len(rows) == 1:
+                        break
+                    middle = len(rows) // 2
+                    self._flush_rows(batch, rows[:middle])
+                    self._flush_rows(batch, rows[middle:])
+                    return
+                deadline = WRITE_SHUTDOWN_TIMEOUT if self._closed else WRITE_RETRY_DEADLINE
+                if time.monotonic() - failing_since >= deadline:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+        self._drop(batch, rows)
+
+    def _drop(self, batch, rows):
+        for row in rows:
+            batch.dropped.add(id(row))
+            logger.error("write-behind dropped %s row: %s", self.model.__tablename__, json.dumps(row, default=str))
+        self.dropped_rows += len(rows)
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            self._flush(batch)
+            if self._closed and not self._batch.rows:
+                return
+
+    def close(self):
+        """Flush whatever is buffered and stop the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(WRITE_SHUTDOWN_TIMEOUT)
+
+    def stats(self):
+        return {
+            "pending": len(self._batch.rows),
+            "flushed_rows": self.flushed_rows,
+            "flushes": self.flushes,
+            "dropped_rows": self.dropped_rows,
+        }
+
+
+def _record_check_ins(session, rows):
+    check_ins = Counter(
+        (row.get("event_id", 0), row["promoter"], row["ticket_type"]) for row in rows if row.get("promoter")
+    )
+    for (event_id, promoter, ticket_type), count in check_ins.items():
+        stats.record_check_in(session, promoter, ticket_type, count, event_id)
+
+
+registrations = WriteBehindBuffer(Registration, "registrations")
+attendance = WriteBehindBuffer(Attendance, "attendance", after_flush=_record_check_ins)
+
+
+@atexit.register
+def close_all():
+    for buffer in (registrations, attendance):
+        buffer.close()